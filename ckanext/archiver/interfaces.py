@@ -18,11 +18,24 @@ class IPipe(Interface):
     triggering a process which transforms the data to another format, or loads
     it into a datastore, or checks it against a schema. These processes can in
     turn put the resulting data into the pipeline
+
+    The params sent are only ids and file paths (e.g. resource_id,
+    package_id, cache_filepath), so that they are cheap to pass on to a job
+    queue. Listeners that need the dataset or resource should look it up.
     """
 
     def receive_data(self, operation, queue, **params):
         pass
 
+    def receive_data_bulk(self, operation, queue, items):
+        '''
+        Receives several notifications of the same operation at once. Each
+        item is a dict of the params that would be passed to receive_data.
+        Override this if they can be processed more efficiently together.
+        '''
+        for params in items:
+            self.receive_data(operation, queue, **params)
+
     @classmethod
     def send_data(cls, operation, queue, **params):
         for observer in plugins.PluginImplementations(cls):
@@ -33,3 +46,21 @@ class IPipe(Interface):
                 # We reraise all exceptions so they are obvious there
                 # is something wrong
                 raise
+
+    @classmethod
+    def send_data_bulk(cls, operation, queue, items):
+        if not items:
+            return
+        for observer in plugins.PluginImplementations(cls):
+            try:
+                if hasattr(observer, 'receive_data_bulk'):
+                    observer.receive_data_bulk(operation, queue, items)
+                else:
+                    # plugin implements IPipe without inherit=True
+                    for params in items:
+                        observer.receive_data(operation, queue, **params)
+            except Exception as ex:
+                log.exception(ex)
+                # We reraise all exceptions so they are obvious there
+                # is something wrong
+                raise
@@ -22,6 +22,42 @@ def compat_enqueue(name, fn, queue, args=None):
         celery.send_task(name, args=args + [queue], task_id=str(uuid.uuid4()))
 
 
+def compat_enqueue_many(name, fn, queue, args_list):
+    u'''
+    Enqueue several background jobs of the same function using Celery or RQ.
+
+    Where RQ supports it (RQ 1.9+) the jobs are sent to Redis in one
+    pipeline, rather than a round-trip each.
+    '''
+    try:
+        from ckan.lib import jobs
+    except ImportError:
+        # Fallback to Celery
+        for args in args_list:
+            compat_enqueue(name, fn, queue, args)
+        return
+
+    rq_queue = jobs.get_queue(queue)
+    if not hasattr(rq_queue, 'enqueue_many'):
+        for args in args_list:
+            compat_enqueue(name, fn, queue, args)
+        return
+
+    from ckan.plugins.toolkit import config
+    timeout = config.get(u'ckan.jobs.timeout',
+                         getattr(jobs, 'DEFAULT_JOB_TIMEOUT', 180))
+    # the same as ckan.lib.jobs.enqueue gives compat_enqueue's jobs
+    job_datas = [rq_queue.prepare_data(fn, args=args, timeout=int(timeout),
+                                       meta={u'title': None})
+                 for args in args_list]
+    with rq_queue.connection.pipeline() as pipe:
+        enqueued_jobs = rq_queue.enqueue_many(job_datas, pipeline=pipe)
+        pipe.execute()
+    for job in enqueued_jobs:
+        log.info(u'Added background job {} to queue "{}"'.format(job.id,
+                                                                 queue))
+
+
 def create_archiver_resource_task(resource, queue):
     if p.toolkit.check_ckan_version(max_version='2.2.99'):
         # earlier CKANs had ResourceGroup
@@ -42,6 +78,24 @@ def create_archiver_package_task(package, queue):
               queue, package.name)
 
 
+def create_archiver_package_tasks(package_ids, queue):
+    '''Queues archival of several packages at once - see
+    compat_enqueue_many().'''
+    compat_enqueue_many('archiver.update_package', update_package, queue,
+                        [[package_id] for package_id in package_ids])
+    log.debug('Archival of %s packages put into celery queue %s',
+              len(package_ids), queue)
+
+
+def create_archiver_resource_tasks(resource_ids, queue):
+    '''Queues archival of several resources at once - see
+    compat_enqueue_many().'''
+    compat_enqueue_many('archiver.update_resource', update_resource, queue,
+                        [[resource_id] for resource_id in resource_ids])
+    log.debug('Archival of %s resources put into celery queue %s',
+              len(resource_ids), queue)
+
+
 def get_extra_from_pkg_dict(pkg_dict, key, default=None):
     for extra in pkg_dict.get('extras', []):
         if extra['key'] == key:
@@ -78,7 +78,7 @@ class Status(object):
 
     @classmethod
     def is_ok(cls, status_id):
-        return status_id in [0, 1]
+        return status_id in (0, 1)
 
 
 broken_enum = {True: 'Broken',
@@ -105,6 +105,7 @@ class Archival(Base):
     url_redirected_to = Column(types.UnicodeText)
 
     # Details of last successful archival
+    url = Column(types.UnicodeText)  # the resource url that was archived
     cache_filepath = Column(types.UnicodeText)
     cache_url = Column(types.UnicodeText)
     size = Column(types.BigInteger, default=0)
@@ -148,11 +149,14 @@ class Archival(Base):
                     .all()
 
     @classmethod
-    def create(cls, resource_id):
+    def create(cls, resource_id, package_id=None):
+        '''Returns a new archival for the resource. If the caller already
+        knows the package_id, passing it saves looking up the resource.'''
         c = cls()
-        resource = model.Resource.get(resource_id)
+        if package_id is None:
+            package_id = model.Resource.get(resource_id).package_id
         c.resource_id = resource_id
-        c.package_id = resource.package_id
+        c.package_id = package_id
         return c
 
     @property
@@ -1,25 +1,46 @@
 from __future__ import absolute_import
 from builtins import str
 import os
+import errno
 import hashlib
 import http.client
+import http.cookiejar
 import requests
 import json
 import tempfile
 import shutil
 import datetime
 import copy
+import functools
 import mimetypes
+import random
 import re
-from time import sleep
-
+import socket
+import threading
+from time import sleep, time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+except ImportError:
+    # python 2 without the 'futures' backport - archive resources serially
+    ThreadPoolExecutor = None
+from requests.adapters import HTTPAdapter
+from requests.utils import requote_uri
 from requests.packages import urllib3
 from future.moves.urllib.parse import urlparse, urljoin, quote, urlunparse
+from future.moves.urllib.request import getproxies
 
 from ckan.common import _
 from ckan.lib import uploader
+from ckan import model
 from ckan import plugins as p
+from ckan.plugins.toolkit import config
 from ckanext.archiver import interfaces as archiver_interfaces
+from ckanext.archiver.model import Status, Archival
 
 import logging
 
@@ -31,6 +52,72 @@ ALLOWED_SCHEMES = set(('http', 'https', 'ftp'))
 
 USER_AGENT = 'ckanext-archiver'
 
+# archival status ids by their text, looked up once (see model.Status)
+STATUS_IDS = dict((text, Status.by_text(text)) for text in (
+    'Archived successfully',
+    'Content has not changed',
+    'URL invalid',
+    'URL request failed',
+    'Download error',
+    'Chose not to download',
+    'Download failure',
+    'System error during archival',
+))
+
+ID_REGEX = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+# Error messages that APIs return in the body, with HTTP status 200:
+# * WMS spec
+#   e.g. https://map.bgs.ac.uk/ArcGIS/services/BGS_Detailed_Geology/MapServer/WMSServer?service=abc
+#   <?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
+#   <ServiceExceptionReport version="1.3.0"
+# * This appears to be an alternative - I can't find the spec.
+#   e.g. http://sedsh13.sedsh.gov.uk/ArcGIS/services/HS/Historic_Scotland/MapServer/WFSServer?service=abc
+#   <ows:ExceptionReport version='1.1.0' language='en' xmlns:ows='http://www.opengis.net/ows'>
+#   <ows:Exception exceptionCode='NoApplicableCode'><ows:ExceptionText>Wrong service type.
+#   </ows:ExceptionText></ows:Exception></ows:ExceptionReport>
+API_ERROR_REGEX = re.compile(u'<(?:ServiceExceptionReport|ows:ExceptionReport)')
+API_ERROR_REGEX_BYTES = re.compile(b'<(?:ServiceExceptionReport|ows:ExceptionReport)')
+
+# Shared by all downloads in this process, so that resources on the same host
+# reuse pooled keep-alive connections rather than reconnecting every time
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+# but no cookies are kept between downloads (as if each had its own session)
+NO_COOKIES_POLICY = http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+SESSION.cookies.set_policy(NO_COOKIES_POLICY)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
+# only created if a server needs it - see _sslv3_session()
+_sslv3 = None
+
+# action functions already looked up - see _get_action()
+_actions = {}
+
+# revision timestamps already looked up - see _revision_timestamp()
+_revision_timestamps = {}
+REVISION_TIMESTAMP_CACHE_SIZE = 1000
+
+# directories known to exist - see _ensure_dir()
+_existing_dirs = set()
+
+# downloads are saved in this subdirectory of the archive dir until they are
+# archived. Any older than TMP_FILE_MAX_AGE were left by a worker that was
+# killed - see _tmp_dir()
+TMP_DIR_NAME = '.tmp'
+TMP_FILE_MAX_AGE = 24 * 60 * 60  # seconds
+
+# settings that are fixed for the life of the worker, read on first use -
+# see verify_https(), _site_url() and _set_user_agent_string()
+_NOT_LOADED = object()
+_verify_https = None
+_ckan_site_url = None
+_user_agent_string = _NOT_LOADED
+
+# maximum number of links link_checker_batch() checks at the same time
+LINK_CHECKER_BATCH_THREADS = 32
+
 # CKAN 2.7 introduces new jobs system
 if p.toolkit.check_ckan_version(max_version='2.6.99'):
     from ckan.lib.celery_app import celery
@@ -49,7 +136,11 @@ if p.toolkit.check_ckan_version(max_version='2.6.99'):
 
     @celery.task(name="archiver.link_checker")
     def link_checker_celery(*args, **kwargs):
-        link_checker(*args, **kwargs)
+        return link_checker(*args, **kwargs)
+
+    @celery.task(name="archiver.link_checker_batch")
+    def link_checker_batch_celery(*args, **kwargs):
+        return link_checker_batch(*args, **kwargs)
 
 
 class ArchiverError(Exception):
@@ -113,8 +204,11 @@ def update_resource(resource_id, queue='bulk'):
 
     log.info('Starting update_resource task: res_id=%r queue=%s', resource_id, queue)
 
-    # HACK because of race condition #1481
-    sleep(2)
+    # The task can be queued before the resource is committed (race
+    # condition #1481), so wait for it to be visible
+    if not _wait_for_resource(resource_id):
+        log.warning('Resource still not visible after waiting: %s',
+                    resource_id)
 
     # Do all work in a sub-routine since it can then be tested without celery.
     # Also put try/except around it is easier to monitor ckan's log rather than
@@ -131,6 +225,22 @@ def update_resource(resource_id, queue='bulk'):
         raise
 
 
+def _wait_for_resource(resource_id, timeout=2.0):
+    '''Polls the database until the resource is visible, backing off from
+    10ms up to 200ms between tries. Returns False if it has not appeared
+    after `timeout` seconds.'''
+    deadline = time() + timeout
+    delay = 0.01
+    while True:
+        if model.Session.query(model.Resource.id) \
+                .filter_by(id=resource_id).scalar():
+            return True
+        if time() >= deadline:
+            return False
+        sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
 def update_package(package_id, queue='bulk'):
     '''
     Archive a package.
@@ -155,23 +265,49 @@ def update_package(package_id, queue='bulk'):
 
 
 def _update_package(package_id, queue, log):
-    from ckan import model
-
-    get_action = toolkit.get_action
-
     num_archived = 0
-    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session}
-    package = get_action('package_show')(context_, {'id': package_id})
-
-    for resource in package['resources']:
-        resource_id = resource['id']
-        res = _update_resource(resource_id, queue, log)
-        if res:
-            num_archived += 1
+    # fetched as the search index wants it, so it can be reused for that
+    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
+                'use_cache': False, 'validate': False}
+    package = _get_action('package_show')(context_, {'id': package_id})
+
+    # The archivals are committed together once all the resources are done,
+    # and only then are the resource notifications sent, so that listeners
+    # see the saved archivals.
+    resource_notifications = []
+    resource_ids = [resource['id'] for resource in package['resources']]
+    num_threads = min(
+        int(config.get('ckanext-archiver.package_archive_threads', 1)),
+        len(resource_ids))
+    try:
+        if num_threads > 1 and ThreadPoolExecutor is not None:
+            # Downloading is I/O bound, so archive several resources at once
+            def update_resource_in_thread(resource_id):
+                # model.Session is per-thread, so each thread commits its own
+                try:
+                    return _update_resource(resource_id, queue, log,
+                                            resource_notifications)
+                finally:
+                    model.repo.commit_and_remove()
+            # wrapped here, where the Flask context is, for the threads
+            jobs = [_with_flask_context(functools.partial(
+                        update_resource_in_thread, resource_id))
+                    for resource_id in resource_ids]
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                futures = [executor.submit(job) for job in jobs]
+                results = [future.result() for future in futures]
+        else:
+            results = [_update_resource(resource_id, queue, log,
+                                        resource_notifications)
+                       for resource_id in resource_ids]
+        num_archived = len([res for res in results if res])
+    finally:
+        model.repo.commit_and_remove()
+        notify_resources(resource_notifications, queue)
 
     if num_archived > 0:
         log.info("Notifying package as %d items were archived", num_archived)
-        notify_package(package, queue)
+        notify_package(package['id'], queue)
     else:
         log.info("Not notifying package as 0 items were archived")
 
@@ -179,26 +315,61 @@ def _update_package(package_id, queue, log):
     # archive info. However skip it if there are downstream plugins that will
     # do this anyway, since it is an expensive step to duplicate.
     if 'qa' not in get_plugins_waiting_on_ipipe():
-        _update_search_index(package_id, log)
+        _update_search_index(package, log)
     else:
         log.info('Search index skipped %s', package['name'])
 
 
-def _update_search_index(package_id, log):
+def _with_flask_context(func):
+    '''
+    Returns func wrapped to run in a copy of the current Flask request
+    context (or failing that, the app context), so that it can be called in
+    another thread - e.g. resource_show needs it to call url_for for an
+    uploaded resource. Call this in the thread that has the context.
+
+    Returns func as it is if there is no context (e.g. CKAN < 2.9).
+    '''
+    try:
+        import flask
+    except ImportError:
+        return func
+    if flask.has_request_context():
+        return flask.copy_current_request_context(func)
+    if flask.has_app_context():
+        app = flask.current_app._get_current_object()
+
+        @functools.wraps(func)
+        def func_in_app_context(*args, **kwargs):
+            with app.app_context():
+                return func(*args, **kwargs)
+        return func_in_app_context
+    return func
+
+
+def _update_search_index(package, log):
     '''
-    Tells CKAN to update its search index for a given package.
+    Tells CKAN to update its search index for a given package dict (from
+    package_show with use_cache=False and validate=False).
+
+    The index is committed straight away, unless
+    ckanext-archiver.search_index_defer_commit is set, for sites where Solr's
+    autoCommit does it.
     '''
-    from ckan import model
     from ckan.lib.search.index import PackageSearchIndex
     package_index = PackageSearchIndex()
-    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
-                'use_cache': False, 'validate': False}
-    package = toolkit.get_action('package_show')(context_, {'id': package_id})
-    package_index.index_package(package, defer_commit=False)
-    log.info('Search indexed %s', package['name'])
-
-
-def _update_resource(resource_id, queue, log):
+    # The dict was shown before its resources were archived, so bring its
+    # archival info up to date
+    archiver_plugin = p.get_plugin('archiver')
+    if archiver_plugin:
+        archiver_plugin.after_dataset_show({}, package)
+    defer_commit = toolkit.asbool(
+        config.get('ckanext-archiver.search_index_defer_commit', False))
+    package_index.index_package(package, defer_commit=defer_commit)
+    log.info('Search indexed %s%s', package['name'],
+             ' (commit deferred)' if defer_commit else '')
+
+
+def _update_resource(resource_id, queue, log, deferred_notifications=None):
     """
     Link check and archive the given resource.
     If successful, updates the archival table with the cache_url & hash etc.
@@ -207,6 +378,9 @@ def _update_resource(resource_id, queue, log):
     Params:
       resource - resource dict
       queue - name of the celery queue
+      deferred_notifications - if a list is given, the archival is not
+          committed and (resource_id, cache_filepath) is appended to it, for
+          the caller to commit and then pass to notify_resources
 
     Should only raise on a fundamental error:
       ArchiverError
@@ -221,46 +395,43 @@ def _update_resource(resource_id, queue, log):
     If not successful, returns None.
     """
 
-    from ckan import model
-    from ckan.plugins.toolkit import config
     from ckanext.archiver import default_settings as settings
-    from ckanext.archiver.model import Status, Archival
-
-    get_action = toolkit.get_action
 
     assert is_id(resource_id), resource_id
     context_ = {'model': model, 'ignore_auth': True, 'session': model.Session}
-    resource = get_action('resource_show')(context_, {'id': resource_id})
+    resource = _get_action('resource_show')(context_, {'id': resource_id})
 
-    if not os.path.exists(settings.ARCHIVE_DIR):
-        log.info("Creating archive directory: %s" % settings.ARCHIVE_DIR)
-        os.mkdir(settings.ARCHIVE_DIR)
+    _ensure_dir(settings.ARCHIVE_DIR)
 
     def _save(status_id, exception, resource, url_redirected_to=None,
               download_result=None, archive_result=None):
         reason = u'%s' % exception
+        defer = deferred_notifications is not None
         save_archival(resource, status_id,
                       reason, url_redirected_to,
                       download_result, archive_result,
-                      log)
-        notify_resource(
-            resource,
-            queue,
-            archive_result.get('cache_filename') if archive_result else None)
+                      log, defer_commit=defer)
+        cache_filepath = \
+            archive_result.get('cache_filename') if archive_result else None
+        if defer:
+            deferred_notifications.append((resource['id'], cache_filepath))
+        else:
+            notify_resource(resource['id'], queue, cache_filepath)
 
     # Download
     try_as_api = False
     requires_archive = True
 
+    site_url = _site_url()
     url = resource['url']
     if not url.startswith('http'):
-        url = config['ckan.site_url'].rstrip('/') + url
+        url = site_url.rstrip('/') + url
 
     if resource.get('url_type') == 'upload':
         upload = uploader.get_resource_uploader(resource)
         filepath = upload.get_path(resource['id'])
 
-        hosted_externally = not url.startswith(config['ckan.site_url']) or urlparse(filepath).scheme != ''
+        hosted_externally = not url.startswith(site_url) or urlparse(filepath).scheme != ''
         # if resource.get('resource_type') == 'file.upload' and not hosted_externally:
         if not hosted_externally:
             log.info("Won't attemp to archive resource uploaded locally: %s" % resource['url'])
@@ -270,7 +441,7 @@ def _update_resource(resource_id, queue, log):
             except IOError as e:
                 log.error('Error while accessing local resource %s: %s', filepath, e)
 
-                download_status_id = Status.by_text('URL request failed')
+                download_status_id = STATUS_IDS['URL request failed']
                 _save(download_status_id, e, resource)
                 return
 
@@ -293,18 +464,18 @@ def _update_resource(resource_id, queue, log):
                                    'cache_url': url}
 
             # Success
-            _save(Status.by_text('Archived successfully'), '', resource,
+            _save(STATUS_IDS['Archived successfully'], '', resource,
                   download_result_mock['url_redirected_to'], download_result_mock, archive_result_mock)
 
             # The return value is only used by tests. Serialized for Celery.
-            return json.dumps(dict(download_result_mock, **archive_result_mock))
+            return _result_json(download_result_mock, archive_result_mock)
             # endif: processing locally uploaded resource
 
     log.info("Attempting to download resource: %s" % resource['url'])
     download_result = None
-    download_status_id = Status.by_text('Archived successfully')
+    download_status_id = STATUS_IDS['Archived successfully']
     context = {
-        'site_url': config.get('ckan.site_url_internally') or config['ckan.site_url'],
+        'site_url': config.get('ckan.site_url_internally') or site_url,
         'cache_url_root': config.get('ckanext-archiver.cache_url_root'),
         'previous': Archival.get_for_resource(resource_id)
         }
@@ -313,31 +484,31 @@ def _update_resource(resource_id, queue, log):
     try:
         download_result = download(context, resource)
     except NotChanged as e:
-        download_status_id = Status.by_text('Content has not changed')
+        download_status_id = STATUS_IDS['Content has not changed']
         try_as_api = False
         requires_archive = False
         err = e
     except LinkInvalidError as e:
-        download_status_id = Status.by_text('URL invalid')
+        download_status_id = STATUS_IDS['URL invalid']
         try_as_api = False
         err = e
     except DownloadException as e:
-        download_status_id = Status.by_text('Download error')
+        download_status_id = STATUS_IDS['Download error']
         try_as_api = True
         err = e
     except DownloadError as e:
-        download_status_id = Status.by_text('Download error')
+        download_status_id = STATUS_IDS['Download error']
         try_as_api = True
         err = e
     except ChooseNotToDownload as e:
-        download_status_id = Status.by_text('Chose not to download')
+        download_status_id = STATUS_IDS['Chose not to download']
         try_as_api = False
         err = e
     except Exception as e:
         if os.environ.get('DEBUG'):
             raise
         log.error('Uncaught download failure: %r, %r', e, e.args)
-        _save(Status.by_text('Download failure'), e, resource)
+        _save(STATUS_IDS['Download failure'], e, resource)
         return
 
     if not Status.is_ok(download_status_id) and err:
@@ -348,7 +519,7 @@ def _update_resource(resource_id, queue, log):
         if try_as_api:
             download_result = api_request(context, resource)
             if download_result:
-                download_status_id = Status.by_text('Archived successfully')
+                download_status_id = STATUS_IDS['Archived successfully']
             # else the download_status_id (i.e. an error) is left what it was
             # from the previous download (i.e. not when we tried it as an API)
 
@@ -367,15 +538,25 @@ def _update_resource(resource_id, queue, log):
         archive_result = archive_resource(context, resource, log, download_result)
     except ArchiveError as e:
         log.error('System error during archival: %r, %r', e, e.args)
-        _save(Status.by_text('System error during archival'), e, resource, download_result['url_redirected_to'])
+        _save(STATUS_IDS['System error during archival'], e, resource, download_result['url_redirected_to'])
         return
 
     # Success
-    _save(Status.by_text('Archived successfully'), '', resource,
+    _save(STATUS_IDS['Archived successfully'], '', resource,
           download_result['url_redirected_to'], download_result, archive_result)
 
     # The return value is only used by tests. Serialized for Celery.
-    return json.dumps(dict(download_result, **archive_result))
+    return _result_json(download_result, archive_result)
+
+
+def _result_json(download_result, archive_result):
+    '''Serializes the combined results of a successful archival, using
+    orjson if it is installed.'''
+    result = download_result.copy()
+    result.update(archive_result)
+    if orjson is not None:
+        return orjson.dumps(result).decode('utf-8')
+    return json.dumps(result)
 
 
 def download(context, resource, url_timeout=30,
@@ -399,11 +580,13 @@ def download(context, resource, url_timeout=30,
     If the basic GET fails then it will try it with common API
     parameters (SPARQL, WMS etc) to get a better response.
 
+    context may have 'cancelled', a threading.Event which, once set, stops
+    the body being downloaded, raising ChooseNotToDownload.
+
     Returns a dict of results of a successful download:
       mimetype, size, hash, headers, saved_file, url_redirected_to
     '''
     from ckanext.archiver import default_settings as settings
-    from ckan.plugins.toolkit import config
 
     if max_content_length == 'default':
         max_content_length = settings.MAX_CONTENT_LENGTH
@@ -415,7 +598,7 @@ def download(context, resource, url_timeout=30,
             not url.startswith('http')):
         url = context['site_url'].rstrip('/') + url
 
-    hosted_externally = not url.startswith(config['ckan.site_url'])
+    hosted_externally = not url.startswith(_site_url())
     if resource.get('url_type') == 'upload' and hosted_externally:
         # ckanext-cloudstorage for example does that
 
@@ -429,9 +612,24 @@ def download(context, resource, url_timeout=30,
 
     headers = _set_user_agent_string({})
 
+    # ask the server to only send the content if it has changed since the
+    # previous archival - as long as that was of the same url, and its file
+    # is still there to keep
+    previous = context.get('previous')
+    if previous and not (previous.url == resource['url'] and
+                         previous.cache_filepath and
+                         os.path.exists(previous.cache_filepath)):
+        previous = None
+    if previous:
+        if previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+
     # start the download - just get the headers
     # May raise DownloadException
-    method_func = {'GET': requests.get, 'POST': requests.post}[method]
+    method_func = {'GET': _with_retries(SESSION.get, log),
+                   'POST': SESSION.post}[method]
     kwargs = {'timeout': url_timeout, 'stream': True, 'headers': headers,
               'verify': verify_https()}
     if 'ckan.download_proxy' in config:
@@ -439,106 +637,119 @@ def download(context, resource, url_timeout=30,
         log.debug('Downloading via proxy %s', download_proxy)
         kwargs['proxies'] = {'http': download_proxy, 'https': download_proxy}
     res = requests_wrapper(log, method_func, url, **kwargs)
-    url_redirected_to = res.url if url != res.url else None
+    # release the connection even if we give up before reading the body
+    try:
+        url_redirected_to = res.url if url != res.url else None
 
-    if context.get('previous') and ('etag' in res.headers):
-        if context.get('previous').etag == res.headers['etag']:
-            log.info("ETAG matches, not downloading content")
-            raise NotChanged("etag suggests content has not changed")
+        if res.status_code == 304:
+            log.info("Server says not modified, not downloading content")
+            raise NotChanged("server responded 304 Not Modified")
 
-    if not res.ok:  # i.e. 404 or something
-        raise DownloadError('Server reported status error: %s %s' %
-                            (res.status_code, res.reason),
-                            url_redirected_to)
-    log.info('GET started successfully. Content headers: %r', res.headers)
+        # not all servers honour conditional requests
+        if previous and ('etag' in res.headers):
+            if previous.etag == res.headers['etag']:
+                log.info("ETAG matches, not downloading content")
+                raise NotChanged("etag suggests content has not changed")
 
-    # record headers
-    mimetype = _clean_content_type(res.headers.get('content-type', '').lower())
+        if not res.ok:  # i.e. 404 or something
+            raise DownloadError('Server reported status error: %s %s' %
+                                (res.status_code, res.reason),
+                                url_redirected_to)
+        log.info('GET started successfully. Content headers: %r', res.headers)
 
-    # make sure resource content-length does not exceed our maximum
-    content_length = res.headers.get('content-length')
+        # record headers
+        mimetype = _clean_content_type(res.headers.get('content-type', '').lower())
 
-    if content_length:
-        try:
-            content_length = int(content_length)
-        except ValueError:
-            # if there are multiple Content-Length headers, requests
-            # will return all the values, comma separated
-            if ',' in content_length:
-                try:
-                    content_length = int(content_length.split(',')[0])
-                except ValueError:
-                    pass
-    if isinstance(content_length, int) and \
-       int(content_length) >= max_content_length:
-        # record fact that resource is too large to archive
-        log.warning('Resource too large to download: %s > max (%s). '
-                    'Resource: %s %r', content_length,
-                    max_content_length, resource['id'], url)
-        raise ChooseNotToDownload(_('Content-length %s exceeds maximum '
-                                    'allowed value %s') %
-                                  (content_length, max_content_length),
-                                  url_redirected_to)
-    # content_length in the headers is useful but can be unreliable, so when we
-    # download, we will monitor it doesn't go over the max.
-
-    # continue the download - stream the response body
-    def get_content():
-        return res.text
-    log.info('Downloading the body')
-    content = requests_wrapper(log, get_content)
-
-    # APIs can return status 200, but contain an error message in the body
-    if response_is_an_api_error(content):
-        raise DownloadError(_('Server content contained an API error message: %s') %
-                            content[:250],
-                            url_redirected_to)
-
-    content_length = len(content)
-    if content_length > max_content_length:
-        raise ChooseNotToDownload(_("Content-length %s exceeds maximum allowed value %s") %
-                                  (content_length, max_content_length),
-                                  url_redirected_to)
+        # make sure resource content-length does not exceed our maximum
+        content_length = res.headers.get('content-length')
 
-    log.info('Saving resource')
+        if content_length:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                # if there are multiple Content-Length headers, requests
+                # will return all the values, comma separated
+                if ',' in content_length:
+                    try:
+                        content_length = int(content_length.split(',')[0])
+                    except ValueError:
+                        pass
+        if isinstance(content_length, int) and \
+           int(content_length) >= max_content_length:
+            # record fact that resource is too large to archive
+            log.warning('Resource too large to download: %s > max (%s). '
+                        'Resource: %s %r', content_length,
+                        max_content_length, resource['id'], url)
+            raise ChooseNotToDownload(_('Content-length %s exceeds maximum '
+                                        'allowed value %s') %
+                                      (content_length, max_content_length),
+                                      url_redirected_to)
+        # content_length in the headers is useful but can be unreliable, so when we
+        # download, we will monitor it doesn't go over the max.
+
+        # continue the download - stream the response body to disk, hashing it
+        # on the way
+        log.info('Downloading and saving the body')
+        try:
+            length, hash, saved_file_path = _save_resource(
+                resource, res, max_content_length,
+                cancelled=context.get('cancelled'))
+        except ChooseNotToDownload as e:
+            raise ChooseNotToDownload(str(e), url_redirected_to)
+        except DownloadError as e:
+            raise DownloadError(str(e), url_redirected_to)
+        log.info('Resource saved. Length: %s File: %s', length, saved_file_path)
+
+        # zero length (or just one byte) indicates a problem
+        if length < 2:
+            # record fact that resource is zero length
+            log.warning('Resource found was length %i - not archiving. Resource: %s %r',
+                        length, resource['id'], url)
+            raise DownloadError(_("Content-length after streaming was %i") % length,
+                                url_redirected_to)
+
+        log.info('Resource downloaded: id=%s url=%r cache_filename=%s length=%s hash=%s',
+                 resource['id'], url, saved_file_path, length, hash)
+
+        return {'mimetype': mimetype,
+                'size': length,
+                'hash': hash,
+                'headers': dict(res.headers),
+                'saved_file': saved_file_path,
+                'url_redirected_to': url_redirected_to,
+                'request_type': method}
+    finally:
+        res.close()
+
+
+def _sha1():
+    '''Returns a new SHA1 hasher. The hash only detects changed content, so
+    where possible (Python 3.9+) it is flagged as not for security, which
+    keeps it available on FIPS-restricted OpenSSL builds.'''
     try:
-        length, hash, saved_file_path = _save_resource(resource, res, max_content_length)
-    except ChooseNotToDownload as e:
-        raise ChooseNotToDownload(str(e), url_redirected_to)
-    log.info('Resource saved. Length: %s File: %s', length, saved_file_path)
-
-    # zero length (or just one byte) indicates a problem
-    if length < 2:
-        # record fact that resource is zero length
-        log.warning('Resource found was length %i - not archiving. Resource: %s %r',
-                    length, resource['id'], url)
-        raise DownloadError(_("Content-length after streaming was %i") % length,
-                            url_redirected_to)
-
-    log.info('Resource downloaded: id=%s url=%r cache_filename=%s length=%s hash=%s',
-             resource['id'], url, saved_file_path, length, hash)
-
-    return {'mimetype': mimetype,
-            'size': length,
-            'hash': hash,
-            'headers': dict(res.headers),
-            'saved_file': saved_file_path,
-            'url_redirected_to': url_redirected_to,
-            'request_type': method}
+        return hashlib.sha1(usedforsecurity=False)
+    except TypeError:
+        return hashlib.sha1()
 
 
 def _file_hashnlength(local_path):
-    BLOCKSIZE = 65536
-    hasher = hashlib.sha1()
-    length = 0
+    BLOCKSIZE = 1024 * 1024
 
-    with open(local_path, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            length += len(buf)
-
-            buf = afile.read(BLOCKSIZE)
+    with open(local_path, 'rb', buffering=0) as afile:
+        length = os.fstat(afile.fileno()).st_size
+        if hasattr(hashlib, 'file_digest'):
+            # python 3.11+ hashes the whole file without leaving C
+            hasher = hashlib.file_digest(afile, _sha1)
+        else:
+            # reuse one buffer rather than allocate a new bytes per block
+            hasher = _sha1()
+            buf = bytearray(BLOCKSIZE)
+            view = memoryview(buf)
+            while True:
+                num_read = afile.readinto(buf)
+                if not num_read:
+                    break
+                hasher.update(view[:num_read])
 
     return (str(hasher.hexdigest()), length)
 
@@ -557,9 +768,13 @@ def archive_resource(context, resource, log, result=None, url_timeout=30):
     """
     from ckanext.archiver import default_settings as settings
     relative_archive_path = os.path.join(resource['id'][:2], resource['id'])
+    _ensure_dir(os.path.join(settings.ARCHIVE_DIR, resource['id'][:2]))
     archive_dir = os.path.join(settings.ARCHIVE_DIR, relative_archive_path)
-    if not os.path.exists(archive_dir):
-        os.makedirs(archive_dir)
+    try:
+        os.mkdir(archive_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
     # try to get a file name from the url
     parsed_url = urlparse(resource.get('url'))
     try:
@@ -568,9 +783,15 @@ def archive_resource(context, resource, log, result=None, url_timeout=30):
     except Exception:
         file_name = "resource"
 
-    # move the temp file to the resource's archival directory
+    # move the temp file to the resource's archival directory. It was saved
+    # in the archive dir, so this is normally just a rename.
     saved_file = os.path.join(archive_dir, file_name)
-    shutil.move(result['saved_file'], saved_file)
+    try:
+        os.rename(result['saved_file'], saved_file)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(result['saved_file'], saved_file)
     log.info('Going to do chmod: %s', saved_file)
     try:
         os.chmod(saved_file, 0o644)  # allow other users to read it
@@ -594,32 +815,140 @@ def notify_resource(resource, queue, cache_filepath):
     '''
     Broadcasts an IPipe notification that an resource archival has taken place
     (or at least the archival object is changed somehow).
+
+    resource is the resource id (or, as before, the resource dict)
     '''
     archiver_interfaces.IPipe.send_data('archived',
-                                        resource_id=resource['id'],
+                                        resource_id=_id_of(resource),
                                         queue=queue,
                                         cache_filepath=cache_filepath)
 
 
+def notify_resources(resources_and_cache_filepaths, queue):
+    '''
+    Broadcasts the IPipe notifications for several resource archivals in one
+    go, given a list of (resource_id, cache_filepath). Listeners can process
+    them together by implementing IPipe.receive_data_bulk.
+    '''
+    archiver_interfaces.IPipe.send_data_bulk(
+        'archived', queue,
+        [{'resource_id': resource_id, 'cache_filepath': cache_filepath}
+         for resource_id, cache_filepath in resources_and_cache_filepaths])
+
+
 def notify_package(package, queue):
     '''
     Broadcasts an IPipe notification that a package archival has taken place
     (or at least the archival object is changed somehow). e.g.
     ckanext-packagezip listens for this
+
+    package is the package id (or, as before, the package dict)
     '''
     archiver_interfaces.IPipe.send_data('package-archived',
-                                        package_id=package['id'],
+                                        package_id=_id_of(package),
                                         queue=queue)
 
 
+def _id_of(obj_or_id):
+    '''Returns the id, given an object dict or the id itself.'''
+    if isinstance(obj_or_id, dict):
+        return obj_or_id['id']
+    return obj_or_id
+
+
+def _get_action(action_name):
+    '''Returns the named action function, remembering it so that the plugin
+    lookup is only done once per process.'''
+    action = _actions.get(action_name)
+    if action is None:
+        action = _actions[action_name] = toolkit.get_action(action_name)
+    return action
+
+
+def _revision_timestamp(revision_id):
+    '''Returns the timestamp of the given revision. Resources in a package
+    usually share a revision, and a revision never changes, so they are
+    remembered, saving a query per resource.
+
+    Raises AttributeError if CKAN has no revisions (CKAN 2.9+).
+    '''
+    timestamp = _revision_timestamps.get(revision_id)
+    if timestamp is None:
+        timestamp = model.Session.query(model.Revision) \
+            .get(revision_id).timestamp
+        if len(_revision_timestamps) >= REVISION_TIMESTAMP_CACHE_SIZE:
+            _revision_timestamps.clear()
+        _revision_timestamps[revision_id] = timestamp
+    return timestamp
+
+
 def get_plugins_waiting_on_ipipe():
     return [observer.name for observer in
             p.PluginImplementations(archiver_interfaces.IPipe)]
 
 
 def verify_https():
-    from ckan.plugins.toolkit import config
-    return toolkit.asbool(config.get('ckanext-archiver.verify_https', True))
+    '''Whether to verify https certificates. Read from config on first use,
+    then fixed for the life of the worker.'''
+    global _verify_https
+    if _verify_https is None:
+        _verify_https = toolkit.asbool(
+            config.get('ckanext-archiver.verify_https', True))
+    return _verify_https
+
+
+def _ensure_dir(path):
+    '''Creates the directory if it doesn't exist. Directories are remembered
+    once seen, so only use this for the archive dir, its temp dir and its
+    2-character subdirectories (which are a bounded set).'''
+    if path in _existing_dirs:
+        return
+    if not os.path.exists(path):
+        log.info("Creating archive directory: %s", path)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    _existing_dirs.add(path)
+
+
+def _tmp_dir():
+    '''Returns the directory to save downloads in until they are archived.
+    It is in the archive dir, so that archive_resource() can move them into
+    place with a rename. The first time in each process, any stale temp
+    files are removed.'''
+    from ckanext.archiver import default_settings as settings
+    tmp_dir = os.path.join(settings.ARCHIVE_DIR, TMP_DIR_NAME)
+    if tmp_dir not in _existing_dirs:
+        _ensure_dir(tmp_dir)
+        _remove_stale_tmp_files(tmp_dir)
+    return tmp_dir
+
+
+def _remove_stale_tmp_files(tmp_dir):
+    '''Removes temp files older than TMP_FILE_MAX_AGE, which were left by a
+    worker that was killed mid-download.'''
+    cutoff = time() - TMP_FILE_MAX_AGE
+    for filename in os.listdir(tmp_dir):
+        filepath = os.path.join(tmp_dir, filename)
+        try:
+            if os.path.isfile(filepath) and \
+                    os.stat(filepath).st_mtime < cutoff:
+                os.remove(filepath)
+                log.info('Removed stale temp file: %s', filepath)
+        except OSError:
+            # e.g. another worker removed it first
+            pass
+
+
+def _site_url():
+    '''Returns ckan.site_url. Read from config on first use, then fixed for
+    the life of the worker.'''
+    global _ckan_site_url
+    if _ckan_site_url is None:
+        _ckan_site_url = str(config['ckan.site_url'])
+    return _ckan_site_url
 
 
 def _clean_content_type(ct):
@@ -635,8 +964,11 @@ def _set_user_agent_string(headers):
     Update the passed headers object with a `User-Agent` key, if there is a
     USER_AGENT_STRING option in settings.
     '''
-    from ckanext.archiver import default_settings as settings
-    ua_str = settings.USER_AGENT_STRING
+    global _user_agent_string
+    if _user_agent_string is _NOT_LOADED:
+        from ckanext.archiver import default_settings as settings
+        _user_agent_string = settings.USER_AGENT_STRING
+    ua_str = _user_agent_string
     if ua_str is not None:
         headers['User-Agent'] = ua_str
     return headers
@@ -651,10 +983,13 @@ def tidy_url(url):
     '''
 
     # Find out if it has unicode characters, and if it does, quote them
-    # so we are left with an ascii string
+    # so we are left with an ascii string. Most URLs are plain ascii, so
+    # only those that aren't need parsing.
+    if isinstance(url, bytes):
+        url = url.decode('utf-8')
     try:
-        url = url.decode('ascii')
-    except Exception:
+        url.encode('ascii')
+    except UnicodeError:
         parts = list(urlparse(url))
         parts[2] = quote(parts[2].encode('utf-8'))
         url = urlunparse(parts)
@@ -684,66 +1019,117 @@ def tidy_url(url):
     return url
 
 
-def _save_resource(resource, response, max_file_size, chunk_size=1024*16):
+def _save_resource(resource, response, max_file_size, chunk_size=1024*64,
+                   sample_size=250, cancelled=None):
     """
-    Write the response content to disk.
+    Write the response content to disk, hashing it in the same pass.
+
+    If the content reaches max_file_size, the download is abandoned, the file
+    removed and ChooseNotToDownload raised.
+
+    APIs can return status 200, but contain an error message in the body, so
+    the first sample_size bytes are checked for one as soon as they arrive.
+    If there is one, the download is abandoned, the file removed and
+    DownloadError raised.
+
+    A failure reading the response raises DownloadException, but a failure
+    writing the file (e.g. the disk is full) is raised as it is.
+
+    If cancelled (a threading.Event) is set, the download is abandoned, the
+    file removed and ChooseNotToDownload raised.
 
     Returns a tuple:
 
         (file length: int, content hash: string, saved file path: string)
     """
-    resource_hash = hashlib.sha1()
+    resource_hash = _sha1()
     length = 0
+    content_start = b''
+    content_start_checked = False
 
-    fd, tmp_resource_file_path = tempfile.mkstemp()
-
-    with open(tmp_resource_file_path, 'wb') as fp:
-        for chunk in response.iter_content(chunk_size=chunk_size,
-                                           decode_unicode=False):
-            fp.write(chunk)
-            length += len(chunk)
-            resource_hash.update(chunk)
+    fd, tmp_resource_file_path = tempfile.mkstemp(dir=_tmp_dir())
 
-            if length >= max_file_size:
-                raise ChooseNotToDownload(
-                    _("Content-length %s exceeds maximum allowed value %s") %
-                    (length, max_file_size))
-
-    os.close(fd)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in _iter_content(response, chunk_size):
+                if cancelled is not None and cancelled.is_set():
+                    raise ChooseNotToDownload(_('Download cancelled'))
+                if not content_start_checked:
+                    content_start += chunk[:sample_size - len(content_start)]
+                    if len(content_start) >= sample_size:
+                        _check_for_api_error(content_start)
+                        content_start_checked = True
+
+                fp.write(chunk)
+                length += len(chunk)
+                resource_hash.update(chunk)
+
+                if length >= max_file_size:
+                    raise ChooseNotToDownload(
+                        _("Content-length %s exceeds maximum allowed value %s") %
+                        (length, max_file_size))
+            if not content_start_checked:
+                _check_for_api_error(content_start)
+    except Exception:
+        os.remove(tmp_resource_file_path)
+        raise
 
     content_hash = str(resource_hash.hexdigest())
     return length, content_hash, tmp_resource_file_path
 
 
+def _iter_content(response, chunk_size):
+    '''Iterates over the response body, like response.iter_content, but with
+    errors reading it reraised as DownloadException (by requests_wrapper).
+    Errors saving it to disk are not wrapped, so they are not mistaken for a
+    problem with the download.'''
+    chunks = response.iter_content(chunk_size=chunk_size,
+                                   decode_unicode=False)
+    while True:
+        chunk = requests_wrapper(log, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _check_for_api_error(content_start):
+    '''Raises DownloadError if the start of the content is an API error
+    message.'''
+    if response_is_an_api_error(content_start):
+        raise DownloadError(_('Server content contained an API error message: %s') %
+                            content_start[:250].decode('utf-8', 'replace'))
+
+
 def save_archival(resource, status_id, reason, url_redirected_to,
-                  download_result, archive_result, log):
+                  download_result, archive_result, log, defer_commit=False):
     '''Writes to the archival table the result of an attempt to download
     the resource.
 
+    If defer_commit is True then the archival is left in the session for the
+    caller to commit.
+
     May propagate a CkanError.
     '''
     now = datetime.datetime.now()
 
-    from ckanext.archiver.model import Archival, Status
-    from ckan import model
-
     archival = Archival.get_for_resource(resource['id'])
     first_archival = not archival
     previous_archival_was_broken = None
     if not archival:
-        archival = Archival.create(resource['id'])
+        archival = Archival.create(resource['id'],
+                                   package_id=resource.get('package_id'))
         model.Session.add(archival)
     else:
         log.info('Archival from before: %r', archival)
         previous_archival_was_broken = archival.is_broken
 
-    try:
-        revision = model.Session.query(model.Revision) \
-            .get(resource['revision_id'])
-        archival.resource_timestamp = revision.timestamp
-    except AttributeError:
-        # CKAN 2.9 doesn't have revisions, so we can't get a timestamp
-        pass
+    # CKAN 2.9 doesn't have revisions, so we can't get a timestamp
+    revision_id = resource.get('revision_id')
+    if revision_id:
+        try:
+            archival.resource_timestamp = _revision_timestamp(revision_id)
+        except AttributeError:
+            pass
 
     # Details of the latest archival attempt
     archival.status_id = status_id
@@ -753,6 +1139,7 @@ def save_archival(resource, status_id, reason, url_redirected_to,
 
     # Details of successful archival
     if archival.is_broken is False:
+        archival.url = resource['url']
         archival.cache_filepath = archive_result['cache_filepath']
         archival.cache_url = archive_result['cache_url']
         archival.size = download_result['size']
@@ -778,6 +1165,10 @@ def save_archival(resource, status_id, reason, url_redirected_to,
             archival.failure_count += 1
 
     archival.updated = now
+    if defer_commit:
+        model.Session.flush()
+        log.info('Archival saved (commit deferred): %r', archival)
+        return
     log.info('Archival saved: %r', archival)
     model.repo.commit_and_remove()
 
@@ -792,7 +1183,6 @@ def requests_wrapper(log, func, *args, **kwargs):
     runs:
         res = requests.get(url, timeout=url_timeout)
     '''
-    from .requests_ssl import SSLv3Adapter
     try:
         try:
             response = func(*args, **kwargs)
@@ -800,10 +1190,7 @@ def requests_wrapper(log, func, *args, **kwargs):
             if 'SSL23_GET_SERVER_HELLO' not in str(e):
                 raise
             log.info('SSLv23 failed so trying again using SSLv3: %r', args)
-            requests_session = requests.Session()
-            requests_session.mount('https://', SSLv3Adapter())
-            func = {requests.get: requests_session.get,
-                    requests.post: requests_session.post}[func]
+            func = getattr(_sslv3_session(), func.__name__)
             response = func(*args, **kwargs)
 
     except requests.exceptions.ConnectionError as e:
@@ -816,6 +1203,8 @@ def requests_wrapper(log, func, *args, **kwargs):
         raise DownloadException(_('Too many redirects'))
     except requests.exceptions.RequestException as e:
         raise DownloadException(_('Error downloading: %s') % e)
+    except ArchiverError:
+        raise
     except Exception as e:
         if os.environ.get('DEBUG'):
             raise
@@ -823,6 +1212,49 @@ def requests_wrapper(log, func, *args, **kwargs):
     return response
 
 
+def _with_retries(func, log, attempts=3, initial_wait=0.5, max_wait=8):
+    '''Wraps a requests function (e.g. SESSION.get), so that a failure to
+    connect is retried a couple of times, with exponential backoff and
+    jitter, rather than failing the archival because of a network blip. The
+    connection pool means a retry is cheap if the blip was just one stale
+    connection.
+
+    Timeouts are not retried - whether connecting (the host is probably
+    down) or reading the response (the server is there but slow) - as waiting
+    again is unlikely to help. Nor are SSL errors, which requests_wrapper()
+    deals with.
+    '''
+    @functools.wraps(func)
+    def func_with_retries(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except (requests.exceptions.SSLError,
+                    requests.exceptions.ConnectTimeout):
+                raise
+            except requests.exceptions.ConnectionError as e:
+                if attempt == attempts - 1:
+                    raise
+                wait = min(max_wait, initial_wait * 2 ** attempt)
+                wait = random.uniform(wait / 2, wait)
+                log.info('Connection failed, trying again in %.1fs: %s',
+                         wait, e)
+                sleep(wait)
+    return func_with_retries
+
+
+def _sslv3_session():
+    '''Returns the session for the (rare) servers that only speak SSLv3,
+    creating it the first time it is needed.'''
+    global _sslv3
+    if _sslv3 is None:
+        from .requests_ssl import SSLv3Adapter
+        _sslv3 = requests.Session()
+        _sslv3.cookies.set_policy(NO_COOKIES_POLICY)
+        _sslv3.mount('https://', SSLv3Adapter())
+    return _sslv3
+
+
 def ogc_request(context, resource, service, wms_version):
     original_url = url = resource['url']
     # Remove parameters
@@ -866,50 +1298,83 @@ def api_request(context, resource):
     # an API request is successful do we want to save the details of it.
     # However download() gets altered for these API requests. So only give
     # download() a copy of 'resource'.
-    for api_request_func in wms_1_3_request, wms_1_1_1_request, wfs_request:
-        resource_copy = copy.deepcopy(resource)
+    #
+    # The probes are independent requests to the same host, so where possible
+    # they are sent at the same time, rather than waiting for each in turn.
+    # The first one (in this order) to succeed is the one that is used, so
+    # once one does, the ones after it are cancelled, rather than download
+    # the same document again.
+    api_request_funcs = (wms_1_3_request, wms_1_1_1_request, wfs_request)
+    if ThreadPoolExecutor is None:
+        for api_request_func in api_request_funcs:
+            download_dict = _try_api_request(api_request_func, context,
+                                             resource)
+            if download_dict:
+                return download_dict
+        return
+
+    probe_contexts = [dict(context, cancelled=threading.Event())
+                      for api_request_func in api_request_funcs]
+    download_dicts = [None] * len(api_request_funcs)
+    with ThreadPoolExecutor(max_workers=len(api_request_funcs)) as executor:
+        futures = [executor.submit(_try_api_request, api_request_func,
+                                   probe_context, resource)
+                   for api_request_func, probe_context
+                   in zip(api_request_funcs, probe_contexts)]
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            i = futures.index(future)
+            download_dicts[i] = future.result()
+            if download_dicts[i]:
+                for later_future, later_context in zip(
+                        futures[i + 1:], probe_contexts[i + 1:]):
+                    later_future.cancel()
+                    later_context['cancelled'].set()
+    successes = [download_dict for download_dict in download_dicts
+                 if download_dict]
+    # tidy up after any later probes that succeeded before being cancelled
+    for download_dict in successes[1:]:
         try:
-            download_dict = api_request_func(context, resource_copy)
-        except ArchiverError as e:
-            log.info('API %s error: %r, %r "%s"', api_request_func,
-                     e, e.args, resource.get('url'))
-            continue
-        except Exception as e:
-            if os.environ.get('DEBUG'):
-                raise
-            log.error('Uncaught API %s failure: %r, %r', api_request_func,
-                      e, e.args)
-            continue
+            os.remove(download_dict['saved_file'])
+        except OSError:
+            pass
+    if successes:
+        return successes[0]
 
-        return download_dict
+
+def _try_api_request(api_request_func, context, resource):
+    '''Runs one of the API requests for api_request() on a copy of the
+    resource. Returns the download dict, or None if it failed.'''
+    resource_copy = copy.deepcopy(resource)
+    try:
+        return api_request_func(context, resource_copy)
+    except ArchiverError as e:
+        log.info('API %s error: %r, %r "%s"', api_request_func,
+                 e, e.args, resource.get('url'))
+    except Exception as e:
+        if os.environ.get('DEBUG'):
+            raise
+        log.error('Uncaught API %s failure: %r, %r', api_request_func,
+                  e, e.args)
 
 
 def is_id(id_string):
     '''Tells the client if the string looks like a revision id or not'''
-    reg_ex = '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
-    return bool(re.match(reg_ex, id_string))
+    return bool(ID_REGEX.match(id_string))
 
 
 def response_is_an_api_error(response_body):
     '''Some APIs return errors as the response body, but HTTP status 200. So we
     need to check response bodies for these error messages.
+
+    response_body can be bytes, so that the download doesn't need to decode
+    it first, or text.
     '''
     response_sample = response_body[:250]  # to allow for <?xml> and <!DOCTYPE> lines
-
-    # WMS spec
-    # e.g. https://map.bgs.ac.uk/ArcGIS/services/BGS_Detailed_Geology/MapServer/WMSServer?service=abc
-    # <?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
-    # <ServiceExceptionReport version="1.3.0"
-    if '<ServiceExceptionReport' in response_sample:
-        return True
-
-    # This appears to be an alternative - I can't find the spec.
-    # e.g. http://sedsh13.sedsh.gov.uk/ArcGIS/services/HS/Historic_Scotland/MapServer/WFSServer?service=abc
-    # <ows:ExceptionReport version='1.1.0' language='en' xmlns:ows='http://www.opengis.net/ows'>
-    # <ows:Exception exceptionCode='NoApplicableCode'><ows:ExceptionText>Wrong service type.
-    # </ows:ExceptionText></ows:Exception></ows:ExceptionReport>
-    if '<ows:ExceptionReport' in response_sample:
-        return True
+    if isinstance(response_sample, bytes):
+        return API_ERROR_REGEX_BYTES.search(response_sample) is not None
+    return API_ERROR_REGEX.search(response_sample) is not None
 
 
 def clean():
@@ -928,6 +1393,7 @@ def link_checker(context, data):
     data is a JSON dict describing the link:
         { 'url': url,
           'url_timeout': url_timeout }
+    (or the same as a dict, when called directly rather than as a task)
 
     Raises LinkInvalidError if the URL is invalid
     Raises LinkHeadRequestError if HEAD request fails
@@ -935,18 +1401,40 @@ def link_checker(context, data):
 
     Returns a json dict of the headers of the request
     """
-    data = json.loads(data)
+    if not isinstance(data, dict):
+        data = json.loads(data)
+    return json.dumps(_check_link(data))
+
+
+def _check_link(data, connections=None):
+    '''Does the work of link_checker, given data as a dict. Returns the
+    headers as a dict.
+
+    connections is an optional dict of keep-alive connections to reuse - see
+    _head_request().'''
     url_timeout = data.get('url_timeout', 30)
 
     error_message = ''
-    headers = {'User-Agent': USER_AGENT}
 
     url = tidy_url(data['url'])
+    parsed_url = urlparse(url)
 
     # Send a head request
     try:
-        res = requests.head(url, timeout=url_timeout)
-        headers = res.headers
+        head_result = None
+        if parsed_url.scheme.lower() in ('http', 'https') and \
+                not _head_request_needs_requests(parsed_url):
+            try:
+                head_result = _head_request(parsed_url, url_timeout,
+                                            connections)
+            except (http.client.InvalidURL, UnicodeError) as e:
+                # a URL that http.client won't send, but requests may cope
+                log.debug('Trying HEAD of %r with requests: %r', url, e)
+        if head_result is None:
+            res = SESSION.head(url, timeout=url_timeout)
+            res.close()
+            head_result = res.status_code, res.reason, res.headers
+        status_code, reason, headers = head_result
     except http.client.InvalidURL as ve:
         log.error("Could not make a head request to %r, error is: %s."
                   " Package is: %r. This sometimes happens when using an old version of requests on a URL"
@@ -965,15 +1453,142 @@ def link_checker(context, data):
         raise LinkHeadRequestError(_('Too many redirects'))
     except requests.exceptions.RequestException as e:
         raise LinkHeadRequestError(_('Error during request: %s') % e)
+    except socket.timeout:
+        raise LinkHeadRequestError(_('Connection timed out after %ss') % url_timeout)
+    except (http.client.HTTPException, socket.error) as e:
+        raise LinkHeadRequestError(_('Connection error: %s') % e)
     except Exception as e:
         raise LinkHeadRequestError(_('Error with the request: %s') % e)
     else:
-        if res.status_code == 405:
+        if status_code == 405:
             # this suggests a GET request may be ok, so proceed to that
             # in the download
             raise LinkHeadMethodNotSupported()
-        if not res.ok or res.status_code >= 400:
+        if status_code >= 400:
             error_message = _('Server returned HTTP error status: %s %s') % \
-                (res.status_code, res.reason)
+                (status_code, reason)
             raise LinkHeadRequestError(error_message)
-    return json.dumps(dict(headers))
+    return dict(headers)
+
+
+def link_checker_batch(context, data):
+    """
+    Checks several links at once, like link_checker, but with the HEAD
+    requests made concurrently, so the total time is more like that of the
+    slowest one than the sum of them all.
+
+    data is a JSON list of the dicts link_checker takes:
+        [{ 'url': url,
+           'url_timeout': url_timeout }, ...]
+
+    Returns a JSON list of results, in the same order. Each is either:
+        { 'url': url, 'headers': headers dict }
+    or if the link check failed:
+        { 'url': url, 'error': error message,
+          'error_type': e.g. 'LinkHeadRequestError' }
+    """
+    links = json.loads(data)
+    # keep-alive connections, shared by the links to the same host and closed
+    # once they are all checked
+    connections = {}
+
+    def check_link(link):
+        result = {'url': link.get('url')}
+        try:
+            result['headers'] = _check_link(link, connections)
+        except LinkCheckerError as e:
+            result['error'] = str(e)
+            result['error_type'] = e.__class__.__name__
+        return result
+
+    try:
+        if ThreadPoolExecutor is None or len(links) < 2:
+            results = [check_link(link) for link in links]
+        else:
+            with ThreadPoolExecutor(
+                    max_workers=min(LINK_CHECKER_BATCH_THREADS, len(links))) \
+                    as executor:
+                results = list(executor.map(check_link, links))
+    finally:
+        for conn in list(connections.values()):
+            conn.close()
+        connections.clear()
+    return json.dumps(results)
+
+
+def _head_request_needs_requests(parsed_url):
+    '''Returns True if the HEAD request needs requests rather than
+    _head_request(), which doesn't handle proxies (e.g. HTTP_PROXY in the
+    environment) or a username and password in the URL.'''
+    return bool(parsed_url.username or parsed_url.password or getproxies())
+
+
+def _head_request(parsed_url, timeout, connections=None):
+    '''
+    Makes a HEAD request using http.client directly. Only the status and
+    headers are needed, so this skips the overhead of requests. Like
+    requests.head, redirects are not followed.
+
+    parsed_url is the result of urlparse(), which the caller already has.
+
+    connections is an optional dict of kept-alive connections, keyed by
+    (scheme, host, port). One to the host is reused if there, and the
+    connection is left in it afterwards - the caller closes them when done.
+    Without it, the connection is closed once the request is made.
+
+    Raises http.client.InvalidURL or UnicodeError for a URL that http.client
+    can't send, which requests may be able to.
+
+    Returns a tuple: (status code, reason, headers dict)
+    '''
+    scheme = parsed_url.scheme.lower()
+    # an IPv6 address comes without its brackets, and with an explicit port
+    # http.client doesn't look for one in it
+    host = parsed_url.hostname.encode('idna').decode('ascii')
+    port = parsed_url.port or (443 if scheme == 'https' else 80)
+    path = parsed_url.path or '/'
+    if parsed_url.query:
+        path += '?' + parsed_url.query
+    # quote any characters that can't be sent as they are (e.g. spaces), as
+    # requests would
+    path = requote_uri(path)
+    key = (scheme, host, port)
+    headers = {'User-Agent': USER_AGENT}
+
+    conn_class = http.client.HTTPSConnection if scheme == 'https' \
+        else http.client.HTTPConnection
+
+    while True:
+        # take the connection out of the pool while in use
+        conn = connections.pop(key, None) if connections is not None \
+            else None
+        reused = conn is not None
+        if not reused:
+            conn = conn_class(host, port)
+        conn.timeout = timeout
+        try:
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            conn.request('HEAD', path, headers=headers)
+            res = conn.getresponse()
+            res.read()
+        except (http.client.BadStatusLine, socket.error) as e:
+            conn.close()
+            if reused and not isinstance(e, socket.timeout):
+                # the server may have dropped the kept-alive connection, so
+                # try again on a new one
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
+        if connections is None:
+            conn.close()
+        else:
+            # another thread may have pooled a connection to the host
+            # meanwhile
+            replaced_conn = connections.get(key)
+            connections[key] = conn
+            if replaced_conn is not None and replaced_conn is not conn:
+                replaced_conn.close()
+        return res.status, res.reason, dict(res.getheaders())
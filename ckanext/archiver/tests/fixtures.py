@@ -1,4 +1,5 @@
 import pytest
+from werkzeug.serving import make_server
 from ckanext.archiver.tests.mock_flask_server import create_app
 
 import threading
@@ -7,9 +8,37 @@ import threading
 @pytest.fixture(scope='session', autouse=True)
 def client():
     app = create_app()
-    port = 9091
-    thread = threading.Thread(target=lambda: app.run(debug=True, port=port, use_reloader=False))
+    # port 0 lets the OS pick a free port, so that test runs in parallel
+    # (e.g. pytest-xdist workers) don't collide. Threaded, so that requests
+    # the archiver makes concurrently (e.g. the API probes) are served
+    # concurrently too.
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
     thread.daemon = True
     thread.start()
 
-    yield "http://127.0.0.1:" + str(port)
+    yield "http://127.0.0.1:" + str(server.server_port)
+
+    server.shutdown()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def archive_dir(tmp_path_factory):
+    # archive into a temp dir that pytest tidies up, rather than the
+    # default /tmp/archive, so tests needn't each remove what they archived
+    from ckanext.archiver import default_settings
+    original_archive_dir = default_settings.ARCHIVE_DIR
+    default_settings.ARCHIVE_DIR = str(tmp_path_factory.mktemp('archive'))
+
+    yield default_settings.ARCHIVE_DIR
+
+    default_settings.ARCHIVE_DIR = original_archive_dir
+
+
+@pytest.fixture
+def testipipe():
+    # the testipipe plugin, with any calls from earlier tests forgotten
+    from ckan import plugins
+    testipipe = plugins.get_plugin('testipipe')
+    testipipe.reset()
+    return testipipe
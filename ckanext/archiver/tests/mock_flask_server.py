@@ -1,6 +1,9 @@
 import os
 from flask import Flask, request, make_response
 
+# served for 'content_long' - just over the archiver's 1MB test limit
+LONG_CONTENT = b'*' * 1000001
+
 
 def create_app():
     app = Flask(__name__)
@@ -10,10 +13,15 @@ def create_app():
     def echo(path):
         status = int(request.args.get('status', 200))
 
+        # conditional GET
+        etag = request.args.get('etag')
+        if etag and request.headers.get('If-None-Match') == etag:
+            return make_response('', 304)
+
         content = request.args.get('content', '')
 
         if 'content_long' in request.args:
-            content = '*' * 1000001
+            content = LONG_CONTENT
 
         response = make_response(content, status)
 
@@ -109,8 +117,14 @@ def create_app():
     return app
 
 
+# the data files don't change during a test run, so each is only read once
+_file_contents = {}
+
+
 def get_file_content(data_filename):
-    filepath = os.path.join(os.path.dirname(__file__), 'data', data_filename)
-    assert os.path.exists(filepath), filepath
-    with open(filepath, 'rb') as f:
-        return f.read()
+    if data_filename not in _file_contents:
+        filepath = os.path.join(os.path.dirname(__file__), 'data', data_filename)
+        assert os.path.exists(filepath), filepath
+        with open(filepath, 'rb') as f:
+            _file_contents[data_filename] = f.read()
+    return _file_contents[data_filename]
@@ -1,8 +1,6 @@
 import pytest
-import tempfile
 
 from ckan import model
-from ckan import plugins
 from ckan.tests import factories
 import ckan.tests.helpers as helpers
 
@@ -20,12 +18,9 @@ class TestApi(object):
     @pytest.mark.usefixtures(u"clean_db")
     def initial_data(cls, clean_db):
         archiver_model.init_tables(model.meta.engine)
-        cls.temp_dir = tempfile.mkdtemp()
 
-    def test_package_show(self, client):
+    def test_package_show(self, client, testipipe):
         url = client + '/?status=200&content=test&content-type=csv'
-        testipipe = plugins.get_plugin('testipipe')
-        testipipe.reset()
 
         pkg_dict = {
             'name': 'test-package-api',
@@ -1,24 +1,25 @@
 from __future__ import print_function
-import logging
 import os
-import shutil
-import tempfile
 import json
+import threading
+import uuid
 
 from future.moves.urllib.parse import quote_plus
 from ckan.plugins.toolkit import config
 import pytest
+import requests
 
 from ckan import model
-from ckan import plugins
 from ckan.logic import get_action
 from ckan.tests import factories as ckan_factories
 
 from ckanext.archiver import model as archiver_model
-from ckanext.archiver.model import Archival
+from ckanext.archiver.model import Archival, Status
 
 
+from ckanext.archiver import tasks
 from ckanext.archiver.tasks import (link_checker,
+                                    link_checker_batch,
                                     update_resource,
                                     update_package,
                                     download,
@@ -29,16 +30,8 @@ from ckanext.archiver.tasks import (link_checker,
                                     )
 
 
-# enable celery logging for when you run nosetests -s
-log = logging.getLogger('ckanext.archiver.tasks')
-
-
-def get_logger():
-    return log
-
-
-update_resource.get_logger = get_logger
-update_package.get_logger = get_logger
+# path on the mock server of a small, successful CSV download
+CSV_PATH = '/?status=200&content=test&content-type=csv'
 
 
 class TestLinkChecker:
@@ -81,22 +74,13 @@ class TestLinkChecker:
         with pytest.raises(LinkCheckerError):
             link_checker(context, data)
 
-    def test_url_with_503(self, client):
-        url = client + '/?status=503'
-        context = json.dumps({})
-        data = json.dumps({'url': url})
-        with pytest.raises(LinkCheckerError):
-            link_checker(context, data)
-
-    def test_url_with_404(self, client):
-        url = client + 'http://localhost:9091/?status=404'
-        context = json.dumps({})
-        data = json.dumps({'url': url})
-        with pytest.raises(LinkCheckerError):
-            link_checker(context, data)
-
-    def test_url_with_405(self, client):  # 405: method (HEAD) not allowed
-        url = client + '/?status=405'
+    @pytest.mark.parametrize('status', [
+        503,
+        404,
+        405,  # method (HEAD) not allowed
+    ])
+    def test_url_with_error_status(self, client, status):
+        url = client + '/?status=%s' % status
         context = json.dumps({})
         data = json.dumps({'url': url})
         with pytest.raises(LinkCheckerError):
@@ -130,6 +114,18 @@ class TestLinkChecker:
         result = json.loads(link_checker(context, data))
         assert result
 
+    def test_url_with_space_in_path(self, client):
+        url = client + u'/a b.csv?status=200'
+        data = json.dumps({'url': url})
+        result = json.loads(link_checker(json.dumps({}), data))
+        assert result
+
+    def test_url_with_non_ascii_query(self, client):
+        url = client + u'/?status=200&q=caf\xe9'
+        data = json.dumps({'url': url})
+        result = json.loads(link_checker(json.dumps({}), data))
+        assert result
+
     def test_good_url(self, client):
         context = json.dumps({})
         url = client + "/?status=200"
@@ -137,6 +133,39 @@ class TestLinkChecker:
         result = json.loads(link_checker(context, data))
         assert result
 
+    def test_batch(self, client):
+        context = json.dumps({})
+        urls = [client + '/?status=200', client + '/?status=404',
+                u'file:///home/root/test.txt']
+        data = json.dumps([{'url': url} for url in urls])
+        result = json.loads(link_checker_batch(context, data))
+        assert [r['url'] for r in result] == urls
+        assert result[0]['headers']
+        assert 'error' not in result[0]
+        assert result[1]['error_type'] == 'LinkHeadRequestError'
+        assert result[2]['error_type'] == 'LinkInvalidError'
+
+    @pytest.mark.skipif(not hasattr(tasks, 'link_checker_batch_celery'),
+                        reason='Celery tasks are only for CKAN < 2.7')
+    def test_batch_celery(self, client):
+        context = json.dumps({})
+        data = json.dumps([{'url': client + '/?status=200'}])
+        result = json.loads(tasks.link_checker_batch_celery(context, data))
+        assert result[0]['headers']
+
+    def test_head_request_connections(self, client):
+        parsed_url = tasks.urlparse(client + '/?status=200')
+        # without a pool the connection is not kept
+        assert tasks._head_request(parsed_url, 10)[0] == 200
+
+        connections = {}
+        assert tasks._head_request(parsed_url, 10, connections)[0] == 200
+        assert len(connections) == 1
+        conn = list(connections.values())[0]
+        assert tasks._head_request(parsed_url, 10, connections)[0] == 200
+        assert list(connections.values()) == [conn]
+        conn.close()
+
 
 @pytest.mark.usefixtures('with_plugins')
 @pytest.mark.ckan_config("ckanext-archiver.cache_url_root", "http://localhost:50001/resources/")
@@ -151,7 +180,6 @@ class TestArchiver:
     @pytest.mark.usefixtures(u"clean_db")
     def initial_data(cls, clean_db):
         archiver_model.init_tables(model.meta.engine)
-        cls.temp_dir = tempfile.mkdtemp()
 
     def _test_package(self, url, format=None):
         pkg = {'resources': [
@@ -170,6 +198,38 @@ class TestArchiver:
             print('ERROR: %s (%s)' % (archival.reason, archival.status))
             raise AssertionError(archival.reason)
 
+    def test_wait_for_resource_appears(self, monkeypatch):
+        pkg = ckan_factories.Dataset()
+        res_id = str(uuid.uuid4())
+        sleeps = []
+
+        def sleep(delay):
+            # the resource gets committed while the task is waiting
+            if not sleeps:
+                model.Session.add(model.Resource(
+                    id=res_id, package_id=pkg['id'], url='http://example.com'))
+                model.repo.commit_and_remove()
+            sleeps.append(delay)
+        monkeypatch.setattr(tasks, 'sleep', sleep)
+
+        assert tasks._wait_for_resource(res_id) is True
+        assert len(sleeps) == 1
+
+    def test_wait_for_resource_times_out(self):
+        assert tasks._wait_for_resource(str(uuid.uuid4()), timeout=0.1) is False
+
+    def test_save_archival_without_revision_id(self):
+        # e.g. CKAN 2.9+, which has no revisions
+        resource = self._test_resource('http://example.com/data.csv')
+        resource.pop('revision_id', None)
+
+        tasks.save_archival(resource, Status.by_text('URL invalid'), 'Test',
+                            None, None, None, tasks.log)
+
+        archival = Archival.get_for_resource(resource['id'])
+        assert archival.reason == 'Test'
+        assert archival.resource_timestamp is None
+
     def test_file_url(self):
         res_id = self._test_resource('file:///home/root/test.txt')['id']  # scheme not allowed
         result = update_resource(res_id)
@@ -183,16 +243,15 @@ class TestArchiver:
         self.assert_archival_error('URL parsing failure', res_id)
 
     def test_resource_hash_and_content_length(self, client):
-        url = client + '/?status=200&content=test&content-type=csv'
+        url = client + CSV_PATH
         res_id = self._test_resource(url)['id']
         result = json.loads(update_resource(res_id))
         assert result['size'] == len('test')
         from hashlib import sha1
         assert result['hash'] == sha1('test'.encode('utf-8')).hexdigest(), result
-        _remove_archived_file(result.get('cache_filepath'))
 
     def test_archived_file(self, client):
-        url = client + '/?status=200&content=test&content-type=csv'
+        url = client + CSV_PATH
         res_id = self._test_resource(url)['id']
         result = json.loads(update_resource(res_id))
 
@@ -204,7 +263,21 @@ class TestArchiver:
             assert len(content) == 1
             assert content[0] == "test"
 
-        _remove_archived_file(result.get('cache_filepath'))
+    def test_not_modified(self, client):
+        url = client + CSV_PATH + '&etag=abc'
+        res_id = self._test_resource(url)['id']
+        result = json.loads(update_resource(res_id))
+
+        # the server replies 304 Not Modified, so the archive is left as it is
+        assert update_resource(res_id) is None
+        archival = Archival.get_for_resource(res_id)
+        assert archival.cache_filepath == result['cache_filepath']
+        assert os.path.exists(result['cache_filepath'])
+
+        # without the archived file, it is not a conditional GET
+        os.remove(result['cache_filepath'])
+        result = json.loads(update_resource(res_id))
+        assert os.path.exists(result['cache_filepath'])
 
     def test_update_url_with_unknown_content_type(self, client):
         url = client + '/?content-type=application/foo&content=test'
@@ -223,7 +296,6 @@ class TestArchiver:
         with open(result['cache_filepath']) as f:
             content = f.read()
             assert '<WMT_MS_Capabilities' in content, content[:1000]
-        _remove_archived_file(result.get('cache_filepath'))
 
     def test_update_with_zero_length(self, client):
         url = client + '/?status=200&content-type=csv'
@@ -286,10 +358,8 @@ class TestArchiver:
         assert result
         assert result['url_redirected_to'] == redirect_url
 
-    def test_ipipe_notified(self, client):
-        url = client + '/?status=200&content=test&content-type=csv'
-        testipipe = plugins.get_plugin('testipipe')
-        testipipe.reset()
+    def test_ipipe_notified(self, client, testipipe):
+        url = client + CSV_PATH
 
         res_id = self._test_resource(url)['id']
 
@@ -303,11 +373,20 @@ class TestArchiver:
         assert params.get('package_id') is None
         assert params.get('resource_id') == res_id
 
+    def test_notify_takes_id_or_dict(self, testipipe):
+        tasks.notify_package('pkg-id', 'queue1')
+        tasks.notify_package({'id': 'pkg-id'}, 'queue1')
+        tasks.notify_resource('res-id', 'queue1', None)
+        tasks.notify_resource({'id': 'res-id'}, 'queue1', None)
+
+        assert [params.get('package_id') for _, _, params in testipipe.calls[:2]] == \
+            ['pkg-id', 'pkg-id']
+        assert [params.get('resource_id') for _, _, params in testipipe.calls[2:]] == \
+            ['res-id', 'res-id']
+
     @pytest.mark.ckan_config("ckan.plugins", "archiver testipipe")
-    def test_ipipe_notified_dataset(self, client):
-        url = client + '/?status=200&content=test&content-type=csv'
-        testipipe = plugins.get_plugin('testipipe')
-        testipipe.reset()
+    def test_ipipe_notified_dataset(self, client, testipipe):
+        url = client + CSV_PATH
 
         pkg = self._test_package(url)
 
@@ -327,6 +406,90 @@ class TestArchiver:
         assert params.get('package_id') == pkg['id']
         assert params.get('resource_id') is None
 
+    @pytest.mark.ckan_config("ckan.plugins", "archiver testipipe")
+    @pytest.mark.parametrize('threads', ['1', '2'])
+    def test_update_package_with_several_resources(self, client, testipipe,
+                                                   ckan_config, monkeypatch,
+                                                   tmp_path, threads):
+        monkeypatch.setitem(ckan_config,
+                            'ckanext-archiver.package_archive_threads',
+                            threads)
+        if not ckan_config.get('ckan.storage_path'):
+            # the uploaded resource's path is in it
+            monkeypatch.setitem(ckan_config, 'ckan.storage_path',
+                                str(tmp_path))
+        url = client + CSV_PATH
+        pkg = ckan_factories.Dataset(resources=[
+            {'url': url, 'format': 'CSV'},
+            {'url': url.replace('content=test', 'content=test2'),
+             'format': 'CSV'},
+            {'url': client + '/?status=404', 'format': 'CSV'},
+            # resource_show calls url_for for this, which needs the Flask
+            # context in a thread. Its file isn't there, so it is broken.
+            {'url': 'test.csv', 'url_type': 'upload', 'format': 'CSV'},
+        ])
+        res_ids = [res['id'] for res in pkg['resources']]
+
+        update_package(pkg['id'], 'queue1')
+
+        archivals = [Archival.get_for_resource(res_id) for res_id in res_ids]
+        assert [archival.is_broken for archival in archivals] == \
+            [False, False, True, True]
+        assert archivals[0].size == len('test')
+        assert archivals[1].size == len('test2')
+        assert archivals[3].status_id == Status.by_text('URL request failed')
+
+        operations = [call[0] for call in testipipe.calls]
+        assert operations == ['archived'] * 4 + ['package-archived']
+        assert set(call[2]['resource_id'] for call in testipipe.calls[:4]) \
+            == set(res_ids)
+
+
+class TestWithRetries:
+    '''Tests of retrying a download that fails to connect'''
+
+    @pytest.fixture(autouse=True)
+    def sleeps(self, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(tasks, 'sleep', sleeps.append)
+        return sleeps
+
+    def _failing_func(self, errors):
+        calls = []
+
+        def func(url):
+            calls.append(url)
+            if errors:
+                raise errors.pop(0)
+            return 'response'
+        return func, calls
+
+    def test_retry_then_success(self, sleeps):
+        func, calls = self._failing_func(
+            [requests.exceptions.ConnectionError('refused')])
+
+        assert tasks._with_retries(func, tasks.log)('url') == 'response'
+        assert len(calls) == 2
+        assert len(sleeps) == 1
+
+    def test_gives_up(self, sleeps):
+        func, calls = self._failing_func(
+            [requests.exceptions.ConnectionError('refused')] * 3)
+
+        with pytest.raises(requests.exceptions.ConnectionError):
+            tasks._with_retries(func, tasks.log, attempts=3)('url')
+        assert len(calls) == 3
+        assert len(sleeps) == 2
+
+    def test_connect_timeout_not_retried(self, sleeps):
+        func, calls = self._failing_func(
+            [requests.exceptions.ConnectTimeout('timed out')])
+
+        with pytest.raises(requests.exceptions.ConnectTimeout):
+            tasks._with_retries(func, tasks.log)('url')
+        assert len(calls) == 1
+        assert not sleeps
+
 
 class TestDownload:
     '''Tests of the download method (and things it calls).
@@ -334,7 +497,6 @@ class TestDownload:
     Doesn't need a fake CKAN to get/set the status of.
     '''
     @pytest.fixture(autouse=True)
-    @pytest.mark.usefixtures(u"clean_index")
     def initialData(cls, clean_db):
         config
         cls.fake_context = {
@@ -350,6 +512,14 @@ class TestDownload:
         pkg = get_action('package_create')(context, pkg)
         return pkg['resources'][0]
 
+    def test_cancelled(self, client):
+        resource = self._test_resource(client + CSV_PATH)
+        context = dict(self.fake_context, cancelled=threading.Event())
+        context['cancelled'].set()
+
+        with pytest.raises(tasks.ChooseNotToDownload):
+            download(context, resource)
+
     def test_head_unsupported(self, client):
         url = client + '/?status=200&method=get&content=test&content-type=csv'
         # This test was more relevant when we did HEAD requests. Now servers
@@ -362,21 +532,42 @@ class TestDownload:
         assert result['saved_file']
 
     def test_download_file(self, client):
-        url = client + '/?status=200&content=test&content-type=csv'
+        url = client + CSV_PATH
         resource = self._test_resource(url)
 
         result = download(self.fake_context, resource)
 
         assert result['saved_file']
         assert os.path.exists(result['saved_file'])
-        _remove_archived_file(result.get('saved_file'))
 
         # Modify the resource and check that the resource size gets updated
         resource['url'] = url.replace('content=test', 'content=test2')
         result = download(self.fake_context, resource)
         assert result['size'] == len('test2')
 
-        _remove_archived_file(result.get('saved_file'))
+    def test_remove_stale_tmp_files(self, tmp_path):
+        tmp_dir = tmp_path / tasks.TMP_DIR_NAME
+        tmp_dir.mkdir()
+        stale = tmp_dir / 'tmpstale'
+        stale.write_text(u'x')
+        old = os.stat(str(stale)).st_mtime - tasks.TMP_FILE_MAX_AGE - 1
+        os.utime(str(stale), (old, old))
+        in_progress = tmp_dir / 'tmpdownloading'
+        in_progress.write_text(u'x')
+
+        tasks._remove_stale_tmp_files(str(tmp_dir))
+
+        assert not stale.exists()
+        assert in_progress.exists()
+
+    def test_cookies_not_kept(self, client):
+        url = client + CSV_PATH + '&Set-Cookie=session%3Dabc'
+        resource = self._test_resource(url)
+
+        result = download(self.fake_context, resource)
+
+        assert result['headers'].get('Set-Cookie') == 'session=abc'
+        assert len(tasks.SESSION.cookies) == 0
 
     def test_wms_1_3(self, client):
         url = client + '/WMS_1_3/'
@@ -386,7 +577,6 @@ class TestDownload:
         assert result
         assert int(result['size']) > 7800, result['length']
         assert result['request_type'] == 'WMS 1.3'
-        _remove_archived_file(result.get('saved_file'))
 
     def test_wms_1_1_1(self, client):
         url = client + '/WMS_1_1_1/'
@@ -396,7 +586,6 @@ class TestDownload:
         assert result
         assert int(result['size']) > 7800, result['length']
         assert result['request_type'] == 'WMS 1.1.1'
-        _remove_archived_file(result.get('saved_file'))
 
     def test_wfs(self, client):
         url = client + '/WFS/'
@@ -406,7 +595,6 @@ class TestDownload:
         assert result
         assert int(result['size']) > 7800, result['length']
         assert result['request_type'] == 'WFS 2.0'
-        _remove_archived_file(result.get('saved_file'))
 
     def test_wms_error(self, client):
         wms_error_1 = '''<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
@@ -423,11 +611,3 @@ Unknown service requested.
         <ows:Exception exceptionCode='NoApplicableCode'><ows:ExceptionText>Unknown operation name.</ows:ExceptionText>
         </ows:Exception></ows:ExceptionReport>'''
         assert response_is_an_api_error(wms_error_2) is True
-
-
-def _remove_archived_file(cache_filepath):
-    if cache_filepath:
-        if os.path.exists(cache_filepath):
-            resource_folder = os.path.split(cache_filepath)[0]
-            if 'fake_resource_id' in resource_folder:
-                shutil.rmtree(resource_folder)
@@ -0,0 +1,34 @@
+from builtins import object
+import pytest
+
+from ckanext.archiver import lib
+from ckanext.archiver.tasks import update_package
+
+QUEUE_NAME = u'test_archiver'
+
+
+class TestCompatEnqueueMany(object):
+
+    @pytest.fixture(autouse=True)
+    def queue(self):
+        from ckan.lib import jobs
+        queue = jobs.get_queue(QUEUE_NAME)
+        queue.empty()
+        yield queue
+        queue.empty()
+
+    def test_jobs_match_compat_enqueue(self, queue):
+        lib.compat_enqueue('archiver.update_package', update_package,
+                           QUEUE_NAME, [u'pkg0'])
+        lib.compat_enqueue_many('archiver.update_package', update_package,
+                                QUEUE_NAME, [[u'pkg1'], [u'pkg2']])
+
+        single_job, batched_jobs = queue.jobs[0], queue.jobs[1:]
+        assert [list(job.args) for job in batched_jobs] == \
+            [[u'pkg1'], [u'pkg2']]
+        for job in batched_jobs:
+            assert job.func_name == single_job.func_name
+            assert job.meta == single_job.meta
+            assert u'title' in job.meta
+            assert job.timeout == single_job.timeout
+            assert job.origin == single_job.origin
@@ -1,40 +1,45 @@
+import errno
 import itertools
 import logging
+import multiprocessing
 import sys
-from time import sleep
 
 import os
 import re
 import shutil
-from sqlalchemy import func
-
-import ckan.plugins as p
-from ckan.plugins.toolkit import config
-
-try:
-    from collections import OrderedDict  # from python 2.7
-except ImportError:
-    from sqlalchemy.util import OrderedDict
 
 
 log = logging.getLogger(__name__)
 
 
 def update(identifiers, queue):
+    from ckan.plugins.toolkit import config
     from ckanext.archiver import lib
+    batch_size = int(config.get('ckanext-archiver.enqueue_batch_size', 500))
+    # queued in batches, to save a round-trip to Redis for each one
+    package_ids = []
+    resource_ids = []
     for pkg_or_res, is_pkg, num_resources_for_pkg, pkg_for_res in \
             _get_packages_and_resources_in_args(identifiers, queue):
         if is_pkg:
             package = pkg_or_res
             log.info('Queuing dataset %s (%s resources) Q:%s', package.name, num_resources_for_pkg, queue)
-            lib.create_archiver_package_task(package, queue)
-            sleep(0.1)  # to try to avoid Redis getting overloaded
+            package_ids.append(package.id)
+            if len(package_ids) >= batch_size:
+                lib.create_archiver_package_tasks(package_ids, queue)
+                package_ids = []
         else:
             resource = pkg_or_res
             package = pkg_for_res
             log.info('Queuing resource %s/%s', package.name, resource.id)
-            lib.create_archiver_resource_task(resource, queue)
-            sleep(0.05)  # to try to avoid Redis getting overloaded
+            resource_ids.append(resource.id)
+            if len(resource_ids) >= batch_size:
+                lib.create_archiver_resource_tasks(resource_ids, queue)
+                resource_ids = []
+    if package_ids:
+        lib.create_archiver_package_tasks(package_ids, queue)
+    if resource_ids:
+        lib.create_archiver_resource_tasks(resource_ids, queue)
 
 
 def _get_packages_and_resources_in_args(identifiers, queue):
@@ -53,7 +58,10 @@ def _get_packages_and_resources_in_args(identifiers, queue):
            num_resources_for_pkg - None
            pkg_for_res - package object relating to the given resource
     '''
+    import ckan.plugins as p
     from ckan import model
+    # lists and queries of packages - queries are iterated a batch at a
+    # time, rather than loading every package into memory before starting
     packages = []
     resources = []
     if identifiers:
@@ -62,18 +70,19 @@ def _get_packages_and_resources_in_args(identifiers, queue):
             group = model.Group.get(identifier)
             if group:
                 if group.is_organization:
-                    packages.extend(
+                    packages.append(
                         model.Session.query(model.Package)
-                            .filter_by(owner_org=group.id))
+                            .filter_by(owner_org=group.id)
+                            .yield_per(1000))
                 else:
-                    packages.extend(group.packages(with_private=True))
+                    packages.append(group.packages(with_private=True))
                 if not queue:
                     queue = 'bulk'
                 continue
             # try arg as a package id/name
             pkg = model.Package.get(identifier)
             if pkg:
-                packages.append(pkg)
+                packages.append([pkg])
                 if not queue:
                     queue = 'priority'
                 continue
@@ -91,29 +100,29 @@ def _get_packages_and_resources_in_args(identifiers, queue):
         # all packages
         pkgs = model.Session.query(model.Package) \
             .filter_by(state='active') \
-            .order_by('name').all()
-        packages.extend(pkgs)
+            .order_by('name')
+        log.info('Datasets to archive: %d', pkgs.count())
+        packages.append(pkgs.yield_per(1000))
         if not queue:
             queue = 'bulk'
 
-        log.info('Datasets to archive: %d', len(packages))
     if resources:
         log.info('Resources to archive: %d', len(resources))
-    if not (packages or resources):
-        log.error('No datasets or resources to process')
-        sys.exit(1)
 
     log.info('Queue: %s', queue)
-    for package in packages:
-        if p.toolkit.check_ckan_version(max_version='2.2.99'):
-            # earlier CKANs had ResourceGroup
+    # earlier CKANs had ResourceGroup
+    ckan_2_2 = p.toolkit.check_ckan_version(max_version='2.2.99')
+    found_any = False
+    for package in itertools.chain.from_iterable(packages):
+        found_any = True
+        if ckan_2_2:
             pkg_resources = \
                 [resource for resource in
                  itertools.chain.from_iterable(
                      (rg.resources_all
                       for rg in package.resource_groups_all)
                  )
-                 if res.state == 'active']
+                 if resource.state == 'active']
         else:
             pkg_resources = \
                 [resource for resource in package.resources_all
@@ -121,12 +130,17 @@ def _get_packages_and_resources_in_args(identifiers, queue):
         yield package, True, len(pkg_resources), None
 
     for resource in resources:
-        if p.toolkit.check_ckan_version(max_version='2.2.99'):
+        found_any = True
+        if ckan_2_2:
             package = resource.resource_group.package
         else:
             package = resource.package
         yield resource, False, None, package
 
+    if not found_any:
+        log.error('No datasets or resources to process')
+        sys.exit(1)
+
 
 def update_test(identifiers, queue):
     from ckanext.archiver import tasks
@@ -152,24 +166,35 @@ def init():
 
 
 def view(package_ref=None):
+    from sqlalchemy import func
     from ckan import model
     from ckanext.archiver.model import Archival
 
     r_q = model.Session.query(model.Resource).filter_by(state='active')
     print('Resources: %i total' % r_q.count())
-    a_q = model.Session.query(Archival)
-    print('Archived resources: %i total' % a_q.count())
-    num_with_cache_url = a_q.filter(Archival.cache_url != '').count()
+    # all the archival stats in one query
+    num_archivals, num_with_cache_url, last_updated = model.Session.query(
+        func.count(Archival.id),
+        func.count(Archival.id).filter(Archival.cache_url != ''),
+        func.max(Archival.updated)).one()
+    print('Archived resources: %i total' % num_archivals)
     print('                    %i with cache_url' % num_with_cache_url)
-    last_updated_res = a_q.order_by(Archival.updated.desc()).first()
-    print('Latest archival: %s' % (last_updated_res.updated.strftime('%Y-%m-%d %H:%M') if last_updated_res else '(no)'))
+    print('Latest archival: %s' % (last_updated.strftime('%Y-%m-%d %H:%M') if last_updated else '(no)'))
 
     if package_ref:
         pkg = model.Package.get(package_ref)
         print('Package %s %s' % (pkg.name, pkg.id))
+        # get the archivals for all the resources at once
+        archivals_by_resource = {}
+        resource_ids = [res.id for res in pkg.resources]
+        if resource_ids:
+            for archival in model.Session.query(Archival) \
+                    .filter(Archival.resource_id.in_(resource_ids)):
+                archivals_by_resource.setdefault(archival.resource_id, []) \
+                    .append(archival)
         for res in pkg.resources:
             print('Resource %s' % res.id)
-            for archival in a_q.filter_by(resource_id=res.id):
+            for archival in archivals_by_resource.get(res.id, []):
                 print('* %r' % archival)
 
 
@@ -195,20 +220,16 @@ def clean_cached_resources():
     print('Before:')
     view()
 
-    q = model.Session.query(Archival).filter(Archival.cache_url != '')
-    archivals = q.all()
-    num_archivals = len(archivals)
-    progress = 0
-    for archival in archivals:
-        archival.cache_url = None
-        archival.cache_filepath = None
-        archival.size = None
-        archival.mimetype = None
-        archival.hash = None
-        progress += 1
-        if progress % 1000 == 0:
-            print('Done %i/%i' % (progress, num_archivals))
-            model.Session.commit()
+    # a single UPDATE, rather than loading and changing each archival
+    num_archivals = model.Session.query(Archival) \
+        .filter(Archival.cache_url != '') \
+        .update({Archival.cache_url: None,
+                 Archival.cache_filepath: None,
+                 Archival.size: None,
+                 Archival.mimetype: None,
+                 Archival.hash: None},
+                synchronize_session=False)
+    print('Done %i' % num_archivals)
     model.Session.commit()
     model.Session.remove()
 
@@ -222,6 +243,8 @@ def report(output_file, delete=False):
         """
     import csv
     from ckan import model
+    from ckan.plugins.toolkit import config
+    from ckanext.archiver.tasks import TMP_DIR_NAME
 
     archive_root = config.get('ckanext-archiver.archive_dir')
     if not archive_root:
@@ -229,7 +252,7 @@ def report(output_file, delete=False):
         return
 
     # We'll use this to match the UUID part of the path
-    uuid_re = re.compile(".*([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}).*")
+    uuid_re = re.compile("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
 
     not_cached_active = 0
     not_cached_deleted = 0
@@ -238,51 +261,75 @@ def report(output_file, delete=False):
     perm_error = 0
     file_no_resource = 0
 
-    with open(output_file, "w") as f:
+    # a big buffer, so that the rows are written out in large blocks
+    with open(output_file, "w", 1024 * 1024) as f:
         writer = csv.writer(f)
         writer.writerow(["Resource ID", "Filepath", "Problem"])
-        resources = {}
-        for resource in model.Session.query(model.Resource).all():
-            resources[resource.id] = True
+        # ids of all the resources. Only the columns needed are queried,
+        # in batches, rather than loading every Resource object.
+        resources = set()
+        resource_rows = model.Session.query(
+            model.Resource.id, model.Resource.state, model.Resource.extras) \
+            .yield_per(5000)
+        for resource_id, state, extras in resource_rows:
+            resources.add(resource_id)
+            extras = extras or {}
 
             # Check the resource's cached_filepath
-            fp = resource.extras.get('cache_filepath')
+            fp = extras.get('cache_filepath')
             if fp is None:
-                if resource.state == 'active':
+                if state == 'active':
                     not_cached_active += 1
                 else:
                     not_cached_deleted += 1
-                writer.writerow([resource.id, str(resource.extras), "Resource not cached: {0}".format(resource.state)])
-                continue
-
-            # Check that the cached file is there and readable
-            if not os.path.exists(fp):
-                if resource.state == 'active':
-                    file_not_found_active += 1
-                else:
-                    file_not_found_deleted += 1
-
-                writer.writerow([resource.id, fp.encode('utf-8'), "File not found: {0}".format(resource.state)])
+                writer.writerow([resource_id, str(extras), "Resource not cached: {0}".format(state)])
                 continue
 
+            # Check that the cached file is there and readable, with a
+            # single stat
             try:
                 os.stat(fp)
-            except OSError:
-                perm_error += 1
-                writer.writerow([resource.id, fp.encode('utf-8'), "File not readable"])
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    if state == 'active':
+                        file_not_found_active += 1
+                    else:
+                        file_not_found_deleted += 1
+
+                    writer.writerow([resource_id, fp.encode('utf-8'), "File not found: {0}".format(state)])
+                else:
+                    perm_error += 1
+                    writer.writerow([resource_id, fp.encode('utf-8'), "File not readable"])
                 continue
 
         # Iterate over the archive root and check each file by matching the
-        # resource_id part of the path to the resources dict
-        for root, _, files in os.walk(archive_root):
+        # resource_id part of the path to the resources set
+        for root, dirs, files in os.walk(archive_root):
+            if root == archive_root and TMP_DIR_NAME in dirs:
+                # downloads in progress, which the workers tidy up
+                dirs.remove(TMP_DIR_NAME)
+            # Files are archived to <archive_dir>/<id[:2]>/<id>/<filename>,
+            # so the resource_id is normally the directory name, and only
+            # needs checking once per directory
+            dir_name = os.path.basename(root)
+            if len(dir_name) == 36 and uuid_re.match(dir_name):
+                dir_in_db = dir_name in resources
+            else:
+                dir_name = None
             for filename in files:
                 archived_path = os.path.join(root, filename)
-                m = uuid_re.match(archived_path)
-                if not m:
-                    writer.writerow([resource.id, archived_path, "Malformed path (no UUID)"])
-                    continue
-
-                if not resources.get(m.groups(0)[0].strip(), False):
+                if dir_name:
+                    file_resource_id = dir_name
+                    in_db = dir_in_db
+                else:
+                    m = uuid_re.search(archived_path)
+                    if not m:
+                        writer.writerow([resource_id, archived_path, "Malformed path (no UUID)"])
+                        continue
+                    file_resource_id = m.group(0)
+                    in_db = file_resource_id in resources
+
+                if not in_db:
                     file_no_resource += 1
 
                     if delete:
@@ -291,18 +338,18 @@ def report(output_file, delete=False):
                             log.info("Unlinked {0}".format(archived_path))
                             os.rmdir(root)
                             log.info("Unlinked {0}".format(root))
-                            writer.writerow([m.groups(0)[0], archived_path, "Resource not found, file deleted"])
+                            writer.writerow([file_resource_id, archived_path, "Resource not found, file deleted"])
                         except Exception as e:
                             log.error("Failed to unlink {0}: {1}".format(archived_path, e))
                     else:
-                        writer.writerow([m.groups(0)[0], archived_path, "Resource not found"])
+                        writer.writerow([file_resource_id, archived_path, "Resource not found"])
 
                     continue
 
     print("General info:")
     print("  Permission error reading file: {0}".format(perm_error))
     print("  file on disk but no resource: {0}".format(file_no_resource))
-    print("  Total resources: {0}".format(model.Session.query(model.Resource).count()))
+    print("  Total resources: {0}".format(len(resources)))
     print("Active resource info:")
     print("  No cache_filepath: {0}".format(not_cached_active))
     print("  cache_filepath not on disk: {0}".format(file_not_found_active))
@@ -325,35 +372,38 @@ def migrate():
         """
     from ckan import model
 
-    MIGRATIONS_ADD = OrderedDict({
-        "etag": "ALTER TABLE archival ADD COLUMN etag character varying",
-        "last_modified": "ALTER TABLE archival ADD COLUMN last_modified character varying"
-    })
+    # lists of (column, sql), so that they run in the order given
+    MIGRATIONS_ADD = [
+        ("etag", "ALTER TABLE archival ADD COLUMN etag character varying"),
+        ("last_modified", "ALTER TABLE archival ADD COLUMN last_modified character varying"),
+        ("url", "ALTER TABLE archival ADD COLUMN url character varying"),
+    ]
 
-    MIGRATIONS_MODIFY = OrderedDict({
-    })
+    MIGRATIONS_MODIFY = [
+    ]
 
     q = "select column_name from INFORMATION_SCHEMA.COLUMNS where table_name = 'archival';"
-    current_cols = list([m[0] for m in model.Session.execute(q)])
-    for k, v in MIGRATIONS_ADD.items():
-        if k not in current_cols:
-            log.info(u"Adding column '{0}'".format(k))
-            log.info(u"Executing '{0}'".format(v))
-            model.Session.execute(v)
-            model.Session.commit()
-
-    for k, v in MIGRATIONS_MODIFY.items():
-        if k in current_cols:
-            log.info(u"Removing column '{0}'".format(k))
-            log.info(u"Executing '{0}'".format(v))
-            model.Session.execute(v)
-            model.Session.commit()
+    current_cols = set(m[0] for m in model.Session.execute(q))
+    migrations = [(u"Adding", k, v) for k, v in MIGRATIONS_ADD
+                  if k not in current_cols] + \
+        [(u"Removing", k, v) for k, v in MIGRATIONS_MODIFY
+         if k in current_cols]
+    for action, k, v in migrations:
+        log.info(u"{0} column '{1}'".format(action, k))
+        log.info(u"Executing '{0}'".format(v))
+        model.Session.execute(v)
+    # all the DDL in one transaction
+    if migrations:
+        model.Session.commit()
     log.info("Migrations complete")
 
 
 def migrate_archiver_dirs():
+    import ckan.plugins as p
     from ckan import model
     from ckan.logic import get_action
+    from ckan.plugins.toolkit import config
+    from sqlalchemy.orm import contains_eager
 
     site_user = get_action('get_site_user')(
         {'model': model, 'ignore_auth': True, 'defer_commit': True}, {}
@@ -362,22 +412,29 @@ def migrate_archiver_dirs():
     site_url_base = config['ckanext-archiver.cache_url_root'].rstrip('/')
     old_dir_regex = re.compile(r'(.*)/([a-f0-9\-]+)/([^/]*)$')
     new_dir_regex = re.compile(r'(.*)/[a-f0-9]{2}/[a-f0-9\-]{36}/[^/]*$')
-    for resource in model.Session.query(model.Resource). \
-            filter(model.Resource.state != model.State.DELETED):
-        if not resource.cache_url or resource.cache_url == 'None':
-            continue
-        if new_dir_regex.match(resource.cache_url):
-            print('Resource with new url already: %s' % resource.cache_url)
-            continue
+    # leave resources without a cache_url, or already moved to the new dir
+    # structure, to the database rather than filtering them in python
+    resources = model.Session.query(model.Resource) \
+        .filter(model.Resource.state != model.State.DELETED) \
+        .filter(model.Resource.cache_url.isnot(None)) \
+        .filter(model.Resource.cache_url.notin_(('', 'None'))) \
+        .filter(~model.Resource.cache_url.op('~')(new_dir_regex.pattern))
+    ckan_2_2 = p.toolkit.check_ckan_version(max_version='2.2.99')
+    if not ckan_2_2:
+        # load each resource's package in the same query
+        resources = resources.join(model.Package) \
+            .options(contains_eager(model.Resource.package))
+    # the (filtered) rows are all fetched before the files are moved and
+    # resource_update commits, rather than streamed
+    to_move = []
+    for resource in resources.all():
         match = old_dir_regex.match(resource.cache_url)
         if not match:
             print('ERROR Could not match url: %s' % resource.cache_url)
             continue
         url_base, res_id, filename = match.groups()
         # check the package isn't deleted
-        # Need to refresh the resource's session
-        resource = model.Session.query(model.Resource).get(resource.id)
-        if p.toolkit.check_ckan_version(max_version='2.2.99'):
+        if ckan_2_2:
             package = None
             if resource.resource_group:
                 package = resource.resource_group.package
@@ -392,42 +449,101 @@ def migrate_archiver_dirs():
             print('ERROR Base URL is incorrect: %r != %r' % (url_base, site_url_base))
             continue
 
-        # move the file
         filepath_base = config['ckanext-archiver.archive_dir']
         old_path = os.path.join(filepath_base, resource.id)
         new_dir = os.path.join(filepath_base, resource.id[:2])
         new_path = os.path.join(filepath_base, resource.id[:2], resource.id)
-        new_filepath = os.path.join(new_path, filename)
-        if not os.path.exists(new_dir):
-            os.mkdir(new_dir)
-        if os.path.exists(new_path) and not os.path.exists(old_path):
-            print('File already moved: %s' % new_path)
-        else:
-            print('File: "%s" -> "%s"' % (old_path, new_path))
-            try:
-                shutil.move(old_path, new_path)
-            except IOError as e:
-                print('ERROR moving resource: %s' % e)
-                continue
-
+        to_move.append(((old_path, new_dir, new_path),
+                        (resource.id, url_base, res_id, filename)))
+
+    # move the files in parallel, in a pool of processes
+    moved = []
+    if to_move:
+        # the workers mustn't inherit the open database connection
+        model.Session.remove()
+        model.meta.engine.dispose()
+        # moves are mostly renames, which don't need a process per CPU
+        pool = multiprocessing.Pool(
+            processes=min(4, multiprocessing.cpu_count()))
+        try:
+            errors = pool.imap(_move_archive_dir,
+                               [paths for paths, _ in to_move],
+                               chunksize=64)
+            for (paths, resource_details), error in zip(to_move, errors):
+                if error:
+                    print(error)
+                    continue
+                moved.append(paths[2:] + resource_details)
+        finally:
+            pool.close()
+            pool.join()
+
+    # the CKAN logic functions aren't process-safe, so the resources are
+    # updated one by one, in this process
+    failed = []
+    for new_path, resource_id, url_base, res_id, filename in moved:
         # change the cache_url and cache_filepath
+        new_filepath = os.path.join(new_path, filename)
         new_cache_url = '/'.join((url_base, res_id[:2], res_id, filename))
-        print('cache_filepath: "%s" -> "%s"' % (resource.extras.get('cache_filepath'), new_filepath))
-        print('cache_url: "%s" -> "%s"' % (resource.cache_url, new_cache_url))
-        context = {'model': model, 'user': site_user['name'], 'ignore_auth': True, 'session': model.Session}
-        data_dict = {'id': resource.id}
-        res_dict = get_action('resource_show')(context, data_dict)
-        res_dict['cache_filepath'] = new_filepath
-        res_dict['cache_url'] = new_cache_url
-        data_dict = res_dict
-        result = get_action('resource_update')(context, data_dict)
+        try:
+            # get it afresh, as earlier updates have committed the session
+            resource = model.Session.query(model.Resource).get(resource_id)
+            print('cache_filepath: "%s" -> "%s"' % (resource.extras.get('cache_filepath'), new_filepath))
+            print('cache_url: "%s" -> "%s"' % (resource.cache_url, new_cache_url))
+            context = {'model': model, 'user': site_user['name'], 'ignore_auth': True, 'session': model.Session}
+            data_dict = {'id': resource.id}
+            res_dict = get_action('resource_show')(context, data_dict)
+            res_dict['cache_filepath'] = new_filepath
+            res_dict['cache_url'] = new_cache_url
+            data_dict = res_dict
+            result = get_action('resource_update')(context, data_dict)
+        except Exception as e:
+            # carry on with the rest, whose files have been moved too
+            model.Session.rollback()
+            print('ERROR updating resource %s: %r' % (resource_id, e))
+            failed.append(resource_id)
+            continue
         if result.get('id') == res_id:
             print('Successfully updated resource')
         else:
             print('ERROR updating resource: %r' % result)
+            failed.append(resource_id)
+    if failed:
+        print('ERROR %i resources have been moved but still have their old '
+              'cache_url/cache_filepath: %s' % (len(failed), ' '.join(failed)))
+
+
+def _move_archive_dir(paths):
+    '''Moves a resource's archived file(s) from the old dir structure to the
+    new one. Run in a worker process by migrate_archiver_dirs.
+
+    Returns an error message, or None if it was moved ok.
+    '''
+    old_path, new_dir, new_path = paths
+    try:
+        os.mkdir(new_dir)
+    except OSError as e:
+        # other workers may be making the same dir
+        if e.errno != errno.EEXIST:
+            return 'ERROR making dir: %s' % e
+    try:
+        # normally on the same filesystem, so a single rename does it
+        os.rename(old_path, new_path)
+        print('File: "%s" -> "%s"' % (old_path, new_path))
+    except OSError as e:
+        if e.errno == errno.ENOENT and os.path.exists(new_path):
+            print('File already moved: %s' % new_path)
+            return
+        # e.g. on another filesystem, or new_path is a non-empty dir
+        print('File: "%s" -> "%s"' % (old_path, new_path))
+        try:
+            shutil.move(old_path, new_path)
+        except IOError as e:
+            return 'ERROR moving resource: %s' % e
 
 
 def size_report():
+    from sqlalchemy import case, func
     from ckan import model
     from ckanext.archiver.model import Archival
     kb = 1024
@@ -439,48 +555,54 @@ def size_report():
         (gb, '100 MB - 1 GB'), (10*gb, '1-10 GB'), (100*gb, '10-100 GB'),
         (gb*gb, '>100 GB'),
     ]
-    previous_bin = (0, '')
-    counts = []
-    total_sizes = []
+    # count and total up all the bins in one query, rather than two each
+    whens = [(Archival.size <= size_bin[0], i)
+             for i, size_bin in enumerate(size_bins)]
+    try:
+        bin_number = case(*whens)
+    except TypeError:
+        # SQLAlchemy < 1.4 takes the whens as a list
+        bin_number = case(whens)
+    q = model.Session.query(bin_number,
+                            func.count(Archival.id),
+                            func.sum(Archival.size)) \
+        .filter(Archival.size > 0) \
+        .filter(Archival.size <= size_bins[-1][0]) \
+        .filter(Archival.cache_filepath != '') \
+        .join(model.Resource,
+              Archival.resource_id == model.Resource.id) \
+        .filter(model.Resource.state != 'deleted') \
+        .join(model.Package,
+              Archival.package_id == model.Package.id) \
+        .filter(model.Package.state != 'deleted') \
+        .group_by(bin_number)
+    counts = [0] * len(size_bins)
+    total_sizes = [0] * len(size_bins)
+    for i, count, total_size in q:
+        counts[i] = count
+        total_sizes[i] = int(total_size or 0)
+
     print('{:>15}{:>10}{:>20}'.format(
         'file size', 'no. files', 'files size (bytes)'))
-    for size_bin in size_bins:
-        q = model.Session.query(Archival) \
-            .filter(Archival.size > previous_bin[0]) \
-            .filter(Archival.size <= size_bin[0]) \
-            .filter(Archival.cache_filepath != '') \
-            .join(model.Resource,
-                  Archival.resource_id == model.Resource.id) \
-            .filter(model.Resource.state != 'deleted') \
-            .join(model.Package,
-                  Archival.package_id == model.Package.id) \
-            .filter(model.Package.state != 'deleted')
-        count = q.count()
-        counts.append(count)
-        total_size = model.Session.query(func.sum(Archival.size)) \
-            .filter(Archival.size > previous_bin[0]) \
-            .filter(Archival.size <= size_bin[0]) \
-            .filter(Archival.cache_filepath != '') \
-            .join(model.Resource,
-                  Archival.resource_id == model.Resource.id) \
-            .filter(model.Resource.state != 'deleted') \
-            .join(model.Package,
-                  Archival.package_id == model.Package.id) \
-            .filter(model.Package.state != 'deleted') \
-            .all()[0][0]
-        total_size = int(total_size or 0)
-        total_sizes.append(total_size)
+    for size_bin, count, total_size in zip(size_bins, counts, total_sizes):
         print('{:>15}{:>10,}{:>20,}'.format(size_bin[1], count, total_size))
-        previous_bin = size_bin
     print('Totals: {:,} {:,}'.format(sum(counts), sum(total_sizes)))
 
 
 def delete_files_larger_than_max_content_length():
+    from sqlalchemy import func
     from ckan import model
     from ckanext.archiver.model import Archival
     from ckanext.archiver import default_settings as settings
     max_size = settings.MAX_CONTENT_LENGTH
-    archivals = model.Session.query(Archival) \
+    # the resource and dataset states come with each archival, rather than
+    # being looked up one by one
+    archivals = model.Session.query(Archival, model.Resource.state,
+                                    model.Package.state) \
+        .outerjoin(model.Resource,
+                   Archival.resource_id == model.Resource.id) \
+        .outerjoin(model.Package,
+                   Archival.package_id == model.Package.id) \
         .filter(Archival.size > max_size) \
         .filter(Archival.cache_filepath != '') \
         .all()
@@ -490,21 +612,23 @@ def delete_files_larger_than_max_content_length():
     print('{} archivals above the {:,} threshold with total size {:,}'.format(
         len(archivals), max_size, total_size))
     input('Press Enter to DELETE them')
-    for archival in archivals:
+    # commit the changes in batches, rather than one by one
+    commit_every = 500
+    uncommitted = 0
+    for archival, resource_state, package_state in archivals:
+        if uncommitted >= commit_every:
+            model.Session.commit()
+            uncommitted = 0
         print('Deleting %r' % archival)
-        resource = model.Resource.get(archival.resource_id)
-        if resource.state == 'deleted':
+        if resource_state == 'deleted':
             print('Nothing to delete - Resource is deleted - deleting archival')
             model.Session.delete(archival)
-            model.Session.commit()
-            model.Session.flush()
+            uncommitted += 1
             continue
-        pkg = model.Package.get(archival.package_id)
-        if pkg.state == 'deleted':
+        if package_state == 'deleted':
             print('Nothing to delete - Dataset is deleted - deleting archival')
             model.Session.delete(archival)
-            model.Session.commit()
-            model.Session.flush()
+            uncommitted += 1
             continue
         filepath = archival.cache_filepath
         if not os.path.exists(filepath):
@@ -516,6 +640,6 @@ def delete_files_larger_than_max_content_length():
             print('ERROR deleting %s' % filepath.decode('utf8'))
         else:
             archival.cache_filepath = None
-            model.Session.commit()
-            model.Session.flush()
+            uncommitted += 1
             print('..deleted %s' % filepath.decode('utf8'))
+    model.Session.commit()